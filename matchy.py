@@ -1,12 +1,16 @@
 """
     matchy.py - Discord bot that matches people into groups
 """
+import asyncio
 import logging
+import signal
 import discord
 from discord.ext import commands
 import os
+from datetime import timedelta
 import matchy.cogs.matcher
 import matchy.cogs.owner
+import matchy.state
 
 logger = logging.getLogger("matchy")
 logger.setLevel(logging.INFO)
@@ -20,8 +24,17 @@ bot = commands.Bot(command_prefix='$',
 
 @bot.event
 async def setup_hook():
-    await bot.add_cog(matchy.cogs.matcher.MatcherCog(bot))
+    task_concurrency = int(os.environ.get("TASK_CONCURRENCY", matchy.cogs.matcher._TASK_CONCURRENCY))
+    await bot.add_cog(matchy.cogs.matcher.MatcherCog(bot, task_concurrency))
     await bot.add_cog(matchy.cogs.owner.OwnerCog(bot))
+    # Docker stops the bot with SIGTERM, which skips atexit, so flush the state and close down here instead
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, close_on_sigterm)
+
+
+def close_on_sigterm():
+    logger.info("Closing down the bot on SIGTERM")
+    matchy.state.State.flush()
+    asyncio.create_task(bot.close())
 
 
 @bot.event
@@ -33,4 +46,10 @@ if __name__ == "__main__":
     handler = logging.StreamHandler()
     token = os.environ.get("TOKEN", None)
     assert token, "$TOKEN required"
+    matchy.state.State.persist_in_background(int(os.environ.get("STATE_WRITE_DELAY_MS", 100)) / 1000,
+                                             int(os.environ.get("STATE_MAX_STALENESS_MS", 1000)) / 1000)
+    max_days = os.environ.get("HISTORY_MAX_DAYS")
+    max_partners = os.environ.get("HISTORY_MAX_PARTNERS")
+    matchy.state.State.set_retention(timedelta(days=int(max_days)) if max_days else None,
+                                     int(max_partners) if max_partners else None)
     bot.run(token, log_handler=handler, root_logger=True)
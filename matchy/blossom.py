@@ -0,0 +1,492 @@
+"""
+Maximum weight matching on general graphs using Edmonds' blossom algorithm
+Follows the O(n^3) primal-dual method described by Galil in
+"Efficient algorithms for finding maximum matching in graphs" (1986),
+as popularised by Joris van Rantwijk's public domain mwmatching.py
+"""
+import time
+
+
+def max_weight_matching(edges: list[tuple[int, int, int]],
+                        max_cardinality: bool = False,
+                        deadline: float | None = None) -> list[int]:
+    """
+    Compute a maximum weight matching for a graph given as (i, j, weight) edges
+    Vertices are the integers 0..n-1 and weights must be integers
+    With max_cardinality only the matchings with the most edges are considered
+    Returns the mate of each vertex, or -1 for unmatched vertices
+
+    If a time.monotonic() deadline passes the matching found so far is returned,
+    which is always valid but may be neither maximum weight nor maximum cardinality
+    """
+    if not edges:
+        return []
+
+    num_edges = len(edges)
+    num_vertices = 1 + max(max(i, j) for (i, j, _) in edges)
+    max_weight = max(0, max(w for (_, _, w) in edges))
+
+    # Edge endpoints are numbered such that endpoint[p] is the vertex at one end of edge p//2
+    # and p^1 is the other end of the same edge
+    endpoint = [edges[p // 2][p % 2] for p in range(2 * num_edges)]
+
+    # The remote endpoints of the edges attached to each vertex
+    neighbend: list[list[int]] = [[] for _ in range(num_vertices)]
+    for (k, (i, j, _)) in enumerate(edges):
+        neighbend[i].append(2 * k + 1)
+        neighbend[j].append(2 * k)
+
+    # The remote endpoint of the matched edge for each vertex, or -1 if single
+    mate = [-1] * num_vertices
+
+    # Blossoms are numbered n..2n-1 while the trivial blossoms of single vertices share their number
+    # label is 0 for unlabeled, 1 for S-blossoms and 2 for T-blossoms
+    label = [0] * (2 * num_vertices)
+    # The endpoint through which a labeled blossom got its label
+    labelend = [-1] * (2 * num_vertices)
+    # The top-level blossom each vertex belongs to
+    inblossom = list(range(num_vertices))
+    # The immediate parent blossom of each blossom, or -1 for top-level blossoms
+    blossomparent = [-1] * (2 * num_vertices)
+    # The ordered sub-blossoms of each non-trivial blossom, starting at the base
+    blossomchilds: list[list[int] | None] = [None] * (2 * num_vertices)
+    # The base vertex of each blossom
+    blossombase = list(range(num_vertices)) + [-1] * num_vertices
+    # The endpoints of the edges that connect each blossom's sub-blossoms
+    blossomendps: list[list[int] | None] = [None] * (2 * num_vertices)
+    # The least-slack edge to a different S-blossom for each vertex or top-level S-blossom
+    bestedge = [-1] * (2 * num_vertices)
+    # The least-slack edges to neighbouring S-blossoms of each non-trivial top-level S-blossom
+    blossombestedges: list[list[int] | None] = [None] * (2 * num_vertices)
+    # Blossom numbers available for reuse
+    unusedblossoms = list(range(num_vertices, 2 * num_vertices))
+    # The dual variables of each vertex then each non-trivial blossom
+    dualvar = [max_weight] * num_vertices + [0] * num_vertices
+    # Whether each edge is tight and can be used freely
+    allowedge = [False] * num_edges
+    # Newly discovered S-vertices waiting to be scanned
+    queue: list[int] = []
+
+    def slack(k: int) -> int:
+        """Twice the slack of an edge, which avoids fractions with integer weights"""
+        (i, j, w) = edges[k]
+        return dualvar[i] + dualvar[j] - 2 * w
+
+    def blossom_leaves(b: int):
+        """Yield every vertex in a blossom"""
+        if b < num_vertices:
+            yield b
+        else:
+            for t in blossomchilds[b]:
+                if t < num_vertices:
+                    yield t
+                else:
+                    yield from blossom_leaves(t)
+
+    def assign_label(w: int, t: int, p: int):
+        """Label a vertex's top-level blossom, reached through endpoint p"""
+        b = inblossom[w]
+        label[w] = label[b] = t
+        labelend[w] = labelend[b] = p
+        bestedge[w] = bestedge[b] = -1
+        if t == 1:
+            # b became an S-blossom so scan all its vertices
+            queue.extend(blossom_leaves(b))
+        elif t == 2:
+            # b became a T-blossom so label its mate as an S-blossom
+            base = blossombase[b]
+            assign_label(endpoint[mate[base]], 1, mate[base] ^ 1)
+
+    def scan_blossom(v: int, w: int) -> int:
+        """
+        Trace back from two S-vertices to find a new blossom or an augmenting path
+        Returns the base of the new blossom, or -1 for an augmenting path
+        """
+        path = []
+        base = -1
+        while v != -1 or w != -1:
+            # Look for a breadcrumb in v's blossom or put a new one down
+            b = inblossom[v]
+            if label[b] & 4:
+                base = blossombase[b]
+                break
+            path.append(b)
+            label[b] = 5
+            # Trace one step back
+            if labelend[b] == -1:
+                # The base of blossom b is single so stop tracing this path
+                v = -1
+            else:
+                v = endpoint[labelend[b]]
+                b = inblossom[v]
+                v = endpoint[labelend[b]]
+            # Swap v and w so that we alternate between both paths
+            if w != -1:
+                (v, w) = (w, v)
+        # Remove the breadcrumbs
+        for b in path:
+            label[b] = 1
+        return base
+
+    def add_blossom(base: int, k: int):
+        """Construct a new blossom with the given base through the S-to-S edge k"""
+        (v, w, _) = edges[k]
+        bb = inblossom[base]
+        bv = inblossom[v]
+        bw = inblossom[w]
+        # Create the blossom
+        b = unusedblossoms.pop()
+        blossombase[b] = base
+        blossomparent[b] = -1
+        blossomparent[bb] = b
+        blossomchilds[b] = path = []
+        blossomendps[b] = endps = []
+        # Trace back from v to the base
+        while bv != bb:
+            blossomparent[bv] = b
+            path.append(bv)
+            endps.append(labelend[bv])
+            v = endpoint[labelend[bv]]
+            bv = inblossom[v]
+        # Add the base sub-blossom and reverse the lists
+        path.append(bb)
+        path.reverse()
+        endps.reverse()
+        endps.append(2 * k)
+        # Trace back from w to the base
+        while bw != bb:
+            blossomparent[bw] = b
+            path.append(bw)
+            endps.append(labelend[bw] ^ 1)
+            w = endpoint[labelend[bw]]
+            bw = inblossom[w]
+        # Set the label and dual variable of the new blossom
+        label[b] = 1
+        labelend[b] = labelend[bb]
+        dualvar[b] = 0
+        # Relabel the vertices, with former T-vertices needing a scan as new S-vertices
+        for v in blossom_leaves(b):
+            if label[inblossom[v]] == 2:
+                queue.append(v)
+            inblossom[v] = b
+        # Work out the least-slack edges from the new blossom to each neighbouring S-blossom
+        bestedgeto = [-1] * (2 * num_vertices)
+        for bv in path:
+            if blossombestedges[bv] is None:
+                # This sub-blossom has no list of least-slack edges, so use its neighbours
+                nblists = [[p // 2 for p in neighbend[v]] for v in blossom_leaves(bv)]
+            else:
+                nblists = [blossombestedges[bv]]
+            for nblist in nblists:
+                for k in nblist:
+                    (i, j, _) = edges[k]
+                    if inblossom[j] == b:
+                        (i, j) = (j, i)
+                    bj = inblossom[j]
+                    if (bj != b and label[bj] == 1
+                            and (bestedgeto[bj] == -1 or slack(k) < slack(bestedgeto[bj]))):
+                        bestedgeto[bj] = k
+            # Forget about the sub-blossom's least-slack edges
+            blossombestedges[bv] = None
+            bestedge[bv] = -1
+        blossombestedges[b] = [k for k in bestedgeto if k != -1]
+        # Select bestedge[b]
+        bestedge[b] = -1
+        for k in blossombestedges[b]:
+            if bestedge[b] == -1 or slack(k) < slack(bestedge[b]):
+                bestedge[b] = k
+
+    def expand_blossom(b: int, endstage: bool):
+        """Expand a top-level blossom back into its sub-blossoms"""
+        # Turn the sub-blossoms into top-level blossoms
+        for s in blossomchilds[b]:
+            blossomparent[s] = -1
+            if s < num_vertices:
+                inblossom[s] = s
+            elif endstage and dualvar[s] == 0:
+                # Recursively expand this sub-blossom
+                expand_blossom(s, endstage)
+            else:
+                for v in blossom_leaves(s):
+                    inblossom[v] = s
+        # If we expand a T-blossom during a stage, its sub-blossoms must be relabeled
+        if not endstage and label[b] == 2:
+            # Start at the sub-blossom through which the expanding blossom obtained its label
+            # and relabel sub-blossoms until we reach the base
+            entrychild = inblossom[endpoint[labelend[b] ^ 1]]
+            # Decide in which direction we will go round the blossom
+            j = blossomchilds[b].index(entrychild)
+            if j & 1:
+                # Start index is odd so go forward and wrap
+                j -= len(blossomchilds[b])
+                jstep = 1
+                endptrick = 0
+            else:
+                # Start index is even so go backward
+                jstep = -1
+                endptrick = 1
+            # Move along the blossom until we get to the base
+            p = labelend[b]
+            while j != 0:
+                # Relabel the T-sub-blossom
+                label[endpoint[p ^ 1]] = 0
+                label[endpoint[blossomendps[b][j - endptrick] ^ endptrick ^ 1]] = 0
+                assign_label(endpoint[p ^ 1], 2, p)
+                # Step to the next S-sub-blossom and note its forward endpoint
+                allowedge[blossomendps[b][j - endptrick] // 2] = True
+                j += jstep
+                p = blossomendps[b][j - endptrick] ^ endptrick
+                # Step to the next T-sub-blossom
+                allowedge[p // 2] = True
+                j += jstep
+            # Relabel the base T-sub-blossom without stepping through to its mate
+            bv = blossomchilds[b][j]
+            label[endpoint[p ^ 1]] = label[bv] = 2
+            labelend[endpoint[p ^ 1]] = labelend[bv] = p
+            bestedge[bv] = -1
+            # Continue along the blossom until we get back to entrychild
+            j += jstep
+            while blossomchilds[b][j] != entrychild:
+                # Examine the vertices of the sub-blossom to see whether it is reachable
+                # from a neighbouring S-vertex outside the expanding blossom
+                bv = blossomchilds[b][j]
+                if label[bv] == 1:
+                    # This sub-blossom just got label S through one of its neighbours
+                    j += jstep
+                    continue
+                for v in blossom_leaves(bv):
+                    if label[v] != 0:
+                        break
+                # If the sub-blossom contains a reachable vertex, assign label T to it
+                if label[v] != 0:
+                    label[v] = 0
+                    label[endpoint[mate[blossombase[bv]]]] = 0
+                    assign_label(v, 2, labelend[v])
+                j += jstep
+        # Recycle the blossom number
+        label[b] = labelend[b] = -1
+        blossomchilds[b] = blossomendps[b] = None
+        blossombase[b] = -1
+        blossombestedges[b] = None
+        bestedge[b] = -1
+        unusedblossoms.append(b)
+
+    def augment_blossom(b: int, v: int):
+        """Swap matched and unmatched edges along the path through blossom b between vertex v and the base"""
+        # Bubble up through the blossom tree from vertex v to an immediate sub-blossom of b
+        t = v
+        while blossomparent[t] != b:
+            t = blossomparent[t]
+        # Recursively deal with the first sub-blossom
+        if t >= num_vertices:
+            augment_blossom(t, v)
+        # Decide in which direction we will go round the blossom
+        i = j = blossomchilds[b].index(t)
+        if i & 1:
+            # Start index is odd so go forward and wrap
+            j -= len(blossomchilds[b])
+            jstep = 1
+            endptrick = 0
+        else:
+            # Start index is even so go backward
+            jstep = -1
+            endptrick = 1
+        # Move along the blossom until we get to the base
+        while j != 0:
+            # Step to the next sub-blossom and augment it recursively
+            j += jstep
+            t = blossomchilds[b][j]
+            p = blossomendps[b][j - endptrick] ^ endptrick
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p])
+            # Step to the next sub-blossom and augment it recursively
+            j += jstep
+            t = blossomchilds[b][j]
+            if t >= num_vertices:
+                augment_blossom(t, endpoint[p ^ 1])
+            # Match the edge connecting those sub-blossoms
+            mate[endpoint[p]] = p ^ 1
+            mate[endpoint[p ^ 1]] = p
+        # Rotate the list of sub-blossoms to put the new base at the front
+        blossomchilds[b] = blossomchilds[b][i:] + blossomchilds[b][:i]
+        blossomendps[b] = blossomendps[b][i:] + blossomendps[b][:i]
+        blossombase[b] = blossombase[blossomchilds[b][0]]
+
+    def augment_matching(k: int):
+        """Swap matched and unmatched edges along the augmenting path through edge k"""
+        (v, w, _) = edges[k]
+        for (s, p) in ((v, 2 * k + 1), (w, 2 * k)):
+            # Match vertex s to remote endpoint p, then trace back from s until we find a single vertex
+            while True:
+                bs = inblossom[s]
+                # Augment through the S-blossom from s to base
+                if bs >= num_vertices:
+                    augment_blossom(bs, s)
+                # Update mate[s]
+                mate[s] = p
+                # Trace one step back
+                if labelend[bs] == -1:
+                    # Reached a single vertex so stop
+                    break
+                t = endpoint[labelend[bs]]
+                bt = inblossom[t]
+                # Trace one more step back
+                s = endpoint[labelend[bt]]
+                j = endpoint[labelend[bt] ^ 1]
+                # Augment through the T-blossom from j to base
+                if bt >= num_vertices:
+                    augment_blossom(bt, j)
+                # Update mate[j]
+                mate[j] = labelend[bt]
+                # Keep the opposite endpoint, it will be assigned to mate[s] next time around
+                p = labelend[bt] ^ 1
+
+    # Each stage augments the matching by one edge, so there are at most n stages
+    for _ in range(num_vertices):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+
+        # Forget all labels and least-slack edges from the previous stage
+        label[:] = [0] * (2 * num_vertices)
+        bestedge[:] = [-1] * (2 * num_vertices)
+        blossombestedges[num_vertices:] = [None] * num_vertices
+        allowedge[:] = [False] * num_edges
+        queue[:] = []
+
+        # Label the single top-level vertices as S
+        for v in range(num_vertices):
+            if mate[v] == -1 and label[inblossom[v]] == 0:
+                assign_label(v, 1, -1)
+
+        augmented = False
+        while True:
+            # Grow the alternating trees from the queued S-vertices
+            while queue and not augmented:
+                v = queue.pop()
+                for p in neighbend[v]:
+                    k = p // 2
+                    w = endpoint[p]
+                    # Ignore edges internal to a blossom
+                    if inblossom[v] == inblossom[w]:
+                        continue
+                    if not allowedge[k]:
+                        kslack = slack(k)
+                        if kslack <= 0:
+                            # Edge k has zero slack so it is allowable
+                            allowedge[k] = True
+                    if allowedge[k]:
+                        if label[inblossom[w]] == 0:
+                            # w is a free vertex or a matched vertex not yet reached, so label it T
+                            assign_label(w, 2, p ^ 1)
+                        elif label[inblossom[w]] == 1:
+                            # w is an S-vertex, so we've found a new blossom or an augmenting path
+                            base = scan_blossom(v, w)
+                            if base >= 0:
+                                add_blossom(base, k)
+                            else:
+                                augment_matching(k)
+                                augmented = True
+                                break
+                        elif label[w] == 0:
+                            # w is inside a T-blossom but not yet reached from an S-vertex
+                            label[w] = 2
+                            labelend[w] = p ^ 1
+                    elif label[inblossom[w]] == 1:
+                        # Keep track of the least-slack non-allowable edge to a different S-blossom
+                        b = inblossom[v]
+                        if bestedge[b] == -1 or kslack < slack(bestedge[b]):
+                            bestedge[b] = k
+                    elif label[w] == 0:
+                        # Keep track of the least-slack edge to a free vertex or one in a T-blossom
+                        if bestedge[w] == -1 or kslack < slack(bestedge[w]):
+                            bestedge[w] = k
+
+            if augmented:
+                break
+
+            # There is no augmenting path under these constraints, so compute a dual adjustment
+            # 1: the minimum dual of any vertex, only without max_cardinality
+            # 2: the minimum slack on any edge between an S-vertex and a free vertex
+            # 3: half the minimum slack on any edge between a pair of S-blossoms
+            # 4: the minimum dual of a T-blossom
+            deltatype = -1
+            delta = deltaedge = deltablossom = None
+
+            if not max_cardinality:
+                deltatype = 1
+                delta = min(dualvar[:num_vertices])
+
+            for v in range(num_vertices):
+                if label[inblossom[v]] == 0 and bestedge[v] != -1:
+                    d = slack(bestedge[v])
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 2
+                        deltaedge = bestedge[v]
+
+            for b in range(2 * num_vertices):
+                if blossomparent[b] == -1 and label[b] == 1 and bestedge[b] != -1:
+                    d = slack(bestedge[b]) // 2
+                    if deltatype == -1 or d < delta:
+                        delta = d
+                        deltatype = 3
+                        deltaedge = bestedge[b]
+
+            for b in range(num_vertices, 2 * num_vertices):
+                if (blossombase[b] >= 0 and blossomparent[b] == -1 and label[b] == 2
+                        and (deltatype == -1 or dualvar[b] < delta)):
+                    delta = dualvar[b]
+                    deltatype = 4
+                    deltablossom = b
+
+            if deltatype == -1:
+                # No further improvement is possible with max_cardinality,
+                # so do a final delta update to make the optimum verifiable
+                deltatype = 1
+                delta = max(0, min(dualvar[:num_vertices]))
+
+            # Update the dual variables
+            for v in range(num_vertices):
+                if label[inblossom[v]] == 1:
+                    dualvar[v] -= delta
+                elif label[inblossom[v]] == 2:
+                    dualvar[v] += delta
+            for b in range(num_vertices, 2 * num_vertices):
+                if blossombase[b] >= 0 and blossomparent[b] == -1:
+                    if label[b] == 1:
+                        dualvar[b] += delta
+                    elif label[b] == 2:
+                        dualvar[b] -= delta
+
+            # Take action at the point where the minimum delta occurred
+            if deltatype == 1:
+                # No further improvement possible, so the optimum is reached
+                break
+            elif deltatype == 2:
+                # Use the least-slack edge to continue the search
+                allowedge[deltaedge] = True
+                (i, j, _) = edges[deltaedge]
+                if label[inblossom[i]] == 0:
+                    (i, j) = (j, i)
+                queue.append(i)
+            elif deltatype == 3:
+                # Use the least-slack edge to continue the search
+                allowedge[deltaedge] = True
+                (i, j, _) = edges[deltaedge]
+                queue.append(i)
+            elif deltatype == 4:
+                # Expand the least-z blossom
+                expand_blossom(deltablossom, False)
+
+        # Stop when no more augmenting paths can be found
+        if not augmented:
+            break
+
+        # End of a stage, so expand all S-blossoms which have zero dual
+        for b in range(num_vertices, 2 * num_vertices):
+            if (blossomparent[b] == -1 and blossombase[b] >= 0
+                    and label[b] == 1 and dualvar[b] == 0):
+                expand_blossom(b, True)
+
+    # Transform mate from remote endpoints to vertices
+    return [endpoint[p] if p >= 0 else -1 for p in mate]
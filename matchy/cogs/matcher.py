@@ -1,6 +1,9 @@
 """
 Matchy bot cog
 """
+import aiohttp
+import asyncio
+import concurrent.futures
 import logging
 import discord
 from discord import app_commands
@@ -18,10 +21,50 @@ import matchy.cogs.strings as strings
 logger = logging.getLogger("cog")
 logger.setLevel(logging.INFO)
 
+# Time budgets for matching groups, in seconds
+# Interactions are deferred while matching, so have up to 15 minutes to respond
+_INTERACTION_MATCH_TIMEOUT = 10.0
+_CHANNEL_MATCH_TIMEOUT = 60.0
+
+# Extra time given to a match in the executor on top of its budget before giving up waiting on it
+_MATCH_TIMEOUT_GRACE = 5.0
+
+# Most scheduled channel tasks to run at once each hour
+_TASK_CONCURRENCY = 10
+
+# Matching is CPU bound, so it's run on these threads to keep the event loop responsive
+# It's pure python and holds the GIL, so more threads would only split a core between matches and starve the event loop
+# Matches queue up for a thread instead, and only start their timeouts once they're running
+_MATCH_THREADS = 2
+_match_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MATCH_THREADS, thread_name_prefix="matching")
+
+# Most thread creations to have in flight at once when posting groups
+# discord.py holds each request until its route's rate limit bucket allows it, so this bounds the queue
+_POST_CONCURRENCY = 5
+# Attempts at each thread before giving up on it, backing off from the delay in seconds between each
+# discord.py already retries server errors itself, and messages aren't retried as that could post them twice
+_POST_ATTEMPTS = 3
+_POST_RETRY_DELAY = 1.0
+
+
+class PostStats():
+    """Stats on how posting the groups in a channel went"""
+
+    def __init__(self):
+        # Number of messages and threads posted
+        self.messages = 0
+        self.threads = 0
+        # Number of retried threads, and threads that couldn't be made at all
+        self.retries = 0
+        self.failed_threads = 0
+        # Wall time taken to match and post everything in seconds
+        self.seconds = 0.0
+
 
 class MatcherCog(commands.Cog):
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, task_concurrency: int = _TASK_CONCURRENCY):
         self.bot = bot
+        self.task_concurrency = task_concurrency
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -56,6 +99,38 @@ class MatcherCog(commands.Cog):
         await interaction.response.send_message(
             strings.user_leave(interaction.user.mention), ephemeral=True, silent=True)
 
+    @app_commands.command(description="Join every member with a role to the matchees for this channel")
+    @commands.guild_only()
+    @app_commands.describe(role="Role whose members should join")
+    async def join_role(self, interaction: discord.Interaction, role: discord.Role):
+        logger.info("Handling /join_role in %s %s from %s with role=%s",
+                    interaction.guild.name, interaction.channel, interaction.user.name, role.name)
+        await self._set_role_active(interaction, role, True)
+
+    @app_commands.command(description="Remove every member with a role from the matchees for this channel")
+    @commands.guild_only()
+    @app_commands.describe(role="Role whose members should leave")
+    async def leave_role(self, interaction: discord.Interaction, role: discord.Role):
+        logger.info("Handling /leave_role in %s %s from %s with role=%s",
+                    interaction.guild.name, interaction.channel, interaction.user.name, role.name)
+        await self._set_role_active(interaction, role, False)
+
+    async def _set_role_active(self, interaction: discord.Interaction, role: discord.Role, active: bool):
+        """Set every member with a role who can see the channel as active (or not) in one write"""
+        # Bail if not a matcher
+        if not state.State.get_user_has_scope(interaction.user.id, AuthScope.MATCHER):
+            await interaction.response.send_message(strings.need_matcher_scope(),
+                                                    ephemeral=True, silent=True)
+            return
+
+        ids = [m.id for m in role.members
+               if not m.bot and interaction.channel.permissions_for(m).view_channel]
+        state.State.set_users_active_in_channel(ids, interaction.channel.id, active)
+
+        msg = strings.role_added if active else strings.role_leave
+        await interaction.response.send_message(
+            msg(role.mention, interaction.channel.mention, len(ids)), ephemeral=True, silent=True)
+
     @app_commands.command(description="Pause your matching in this channel for a number of days")
     @commands.guild_only()
     @app_commands.describe(days="Days to pause for (defaults to 7)")
@@ -175,13 +250,19 @@ class MatcherCog(commands.Cog):
         if not members_min:
             members_min = 3
 
+        # Matching can take a while, so let discord know we're working on it
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
         # Grab the groups
-        groups = matching.active_members_to_groups(
-            interaction.channel, members_min)
+        try:
+            groups = await active_members_to_groups(interaction.channel, members_min, _INTERACTION_MATCH_TIMEOUT)
+        except TimeoutError:
+            await interaction.followup.send(strings.match_timed_out(), ephemeral=True, silent=True)
+            return
 
         # Let the user know when there's nobody to match
         if not groups:
-            await interaction.response.send_message(strings.nobody_to_match(), ephemeral=True, silent=True)
+            await interaction.followup.send(strings.nobody_to_match(), ephemeral=True, silent=True)
             return
 
         # Post about all the groups with a button to send to the channel
@@ -199,23 +280,51 @@ class MatcherCog(commands.Cog):
             # Let a non-matcher know why they don't have the button
             msg += "\n\n" + strings.need_matcher_to_post()
 
-        await interaction.response.send_message(msg, ephemeral=True, silent=True, view=view)
+        await interaction.followup.send(msg, ephemeral=True, silent=True, view=view)
 
         logger.info("Done.")
 
     @tasks.loop(time=[time(hour=h) for h in range(24)])
     async def run_hourly_tasks(self):
-        """Run any hourly tasks we have"""
-
-        for (channel, min) in state.State.get_active_match_tasks():
-            logger.info("Scheduled match task triggered in %s", channel)
-            msg_channel = self.bot.get_channel(int(channel))
-            await match_groups_in_channel(msg_channel, min)
-
-        for (channel, _) in state.State.get_active_match_tasks(datetime.now() + timedelta(days=1)):
-            logger.info("Reminding about scheduled task in %s", channel)
-            msg_channel = self.bot.get_channel(int(channel))
-            await msg_channel.send(strings.reminder())
+        """
+        Run any hourly tasks we have
+        Each channel's tasks run alongside the others, up to the concurrency cap
+        Any match history past the retention policy is archived once they're done
+        """
+        scheduled = datetime.now().replace(minute=0, second=0, microsecond=0)
+        limit = asyncio.Semaphore(self.task_concurrency)
+
+        jobs = [self._run_channel_task(limit, scheduled, "match", channel, match_groups_in_channel, min)
+                for (channel, min) in state.State.get_active_match_tasks()]
+        jobs += [self._run_channel_task(limit, scheduled, "reminder", channel, send_reminder)
+                 for (channel, _) in state.State.get_active_match_tasks(datetime.now() + timedelta(days=1))]
+        await asyncio.gather(*jobs)
+
+        # The state isn't thread safe, so this stays on the event loop, but it only looks at each user's oldest partners
+        try:
+            state.State.archive_history()
+        except Exception:
+            logger.exception("Failed to archive match history")
+
+    async def _run_channel_task(self, limit: asyncio.Semaphore, scheduled: datetime, name: str,
+                                channel_id: str, task, *args):
+        """Run a scheduled task on a channel, logging rather than raising any failure"""
+        async with limit:
+            logger.info("Scheduled %s task started in %s, %.2fs after it was due",
+                        name, channel_id, (datetime.now() - scheduled).total_seconds())
+            channel = self.bot.get_channel(int(channel_id))
+            if channel is None:
+                logger.warning("Couldn't find channel %s for scheduled %s task", channel_id, name)
+                return
+
+            try:
+                await task(channel, *args)
+            except Exception:
+                logger.exception("Scheduled %s task failed in %s", name, channel_id)
+                return
+
+            logger.info("Scheduled %s task finished in %s, %.2fs after it was due",
+                        name, channel_id, (datetime.now() - scheduled).total_seconds())
 
 
 # Increment when adjusting the custom_id so we don't confuse old users
@@ -256,30 +365,119 @@ class MatchDynamicButton(discord.ui.DynamicItem[discord.ui.Button],
         await intrctn.response.send_message(content=strings.matching(), ephemeral=True)
 
         # Perform the match
-        await match_groups_in_channel(intrctn.channel, self.min)
+        try:
+            await match_groups_in_channel(intrctn.channel, self.min)
+        except TimeoutError:
+            await intrctn.followup.send(strings.match_timed_out(), ephemeral=True, silent=True)
 
 
-async def match_groups_in_channel(channel: discord.channel, min: int):
-    """Match up the groups in a given channel"""
-    groups = matching.active_members_to_groups(channel, min)
+async def active_members_to_groups(channel: discord.channel, min: int, timeout: float) -> list[list[discord.Member]]:
+    """
+    Create groups from the active members of a channel without blocking the event loop
+    The members and their history are gathered here, then matched on a worker thread
+    The timeout only starts once a thread picks up the match, rather than while it's queued behind others
+    Matching stops itself once the timeout runs out, and waiting on it can be cancelled at any point
+    """
+    snapshot = matching.snapshot_active_members(channel)
+    stats = matching.MatchStats()
+    loop = asyncio.get_running_loop()
+    started = loop.create_future()
+
+    def match():
+        loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+        return matching.snapshot_to_groups(snapshot, min, timeout, stats)
+
+    job = loop.run_in_executor(_match_executor, match)
+    try:
+        await started
+    except asyncio.CancelledError:
+        job.cancel()
+        raise
+    try:
+        groups = await asyncio.wait_for(job, timeout + _MATCH_TIMEOUT_GRACE)
+    except TimeoutError:
+        logger.warning("Gave up waiting on matching %s after %.2fs", channel, timeout + _MATCH_TIMEOUT_GRACE)
+        raise
+    logger.info("Matched in %.2fs with %s attempt(s)", stats.seconds, stats.attempts)
+    return groups
+
+
+async def send_reminder(channel: discord.channel):
+    """Remind a channel about its upcoming scheduled match"""
+    await channel.send(strings.reminder())
+
+
+async def _post_with_retries(stats: PostStats, post, *args, **kwargs):
+    """
+    Make a post, retrying with backoff if the connection to Discord fails
+    Only use this for posts that can't be duplicated, as the first attempt may have got through
+    """
+    for attempt in range(_POST_ATTEMPTS):
+        try:
+            return await post(*args, **kwargs)
+        except (aiohttp.ClientError, OSError, TimeoutError) as e:
+            if attempt + 1 == _POST_ATTEMPTS:
+                raise
+            stats.retries += 1
+            logger.warning("Retrying post after attempt %s failed: %s", attempt + 1, e)
+            await asyncio.sleep(_POST_RETRY_DELAY * 2**attempt)
+
+
+async def _create_thread(channel: discord.channel,
+                         group: list[discord.Member],
+                         message: discord.Message,
+                         limit: asyncio.Semaphore,
+                         stats: PostStats):
+    """Set up a thread for a match, logging rather than raising if it couldn't be made"""
+    async with limit:
+        try:
+            await _post_with_retries(stats, channel.create_thread,
+                                     name=strings.thread_title([m.display_name for m in group]),
+                                     message=message,
+                                     reason="Creating a matching thread")
+            stats.threads += 1
+        except (discord.HTTPException, aiohttp.ClientError, OSError, TimeoutError) as e:
+            stats.failed_threads += 1
+            logger.warning("Failed to create a thread in %s: %s", channel, e)
+
+
+async def match_groups_in_channel(channel: discord.channel, min: int) -> PostStats:
+    """
+    Match up the groups in a given channel
+    The group messages are sent in order, while the threads for them are created alongside
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    stats = PostStats()
+    groups = await active_members_to_groups(channel, min, _CHANNEL_MATCH_TIMEOUT)
+
+    # Set up threads for the matches if the bot has permissions to do so
+    create_threads = channel.permissions_for(channel.guild.me).create_public_threads
+    limit = asyncio.Semaphore(_POST_CONCURRENCY)
+    threads = []
 
     # Send the groups
-    for group in groups:
-        message = await channel.send(
-            strings.matched_up([m.mention for m in group]))
-        # Set up a thread for this match if the bot has permissions to do so
-        if channel.permissions_for(channel.guild.me).create_public_threads:
-            await channel.create_thread(
-                name=strings.thread_title([m.display_name for m in group]),
-                message=message,
-                reason="Creating a matching thread")
+    try:
+        for group in groups:
+            message = await channel.send(strings.matched_up([m.mention for m in group]))
+            stats.messages += 1
+            if create_threads:
+                threads.append(asyncio.create_task(_create_thread(channel, group, message, limit, stats)))
+    finally:
+        # Let any threads already started finish up, even if a message failed to send
+        await asyncio.gather(*threads)
 
     # Close off with a message
     await channel.send(strings.matching_done())
+    stats.messages += 1
     # Save the groups to the history
     state.State.log_groups(groups)
 
+    stats.seconds = loop.time() - start
     logger.info("Done! Matched into %s groups.", len(groups))
+    logger.info("Posted %s message(s) and %s thread(s) in %.2fs with %s retries and %s failed thread(s)",
+                stats.messages, stats.threads, stats.seconds, stats.retries, stats.failed_threads)
+    return stats
 
 
 class ScheduleButton(discord.ui.Button):
@@ -36,6 +36,7 @@ class OwnerCog(commands.Cog):
         """
         await ctx.reply("Closing bot...", ephemeral=True)
         logger.info("Closing down the bot")
+        state.State.flush()
         await self._bot.close()
 
     @commands.command()
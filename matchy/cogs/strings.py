@@ -26,6 +26,20 @@ def user_added(c): return [
 ]
 
 
+@randomised
+def role_added(r, c, n): return [
+    f"Added {n} members of {r} to {c}!",
+    f"{n} members of {r} have joined the matchee list on {c}!",
+]
+
+
+@randomised
+def role_leave(r, c, n): return [
+    f"Removed {n} members of {r} from {c}",
+    f"{n} members of {r} have left the matchee list on {c}",
+]
+
+
 @randomised
 def user_leave(m): return [
     f"No worries {m}. Come back soon :)",
@@ -109,6 +123,13 @@ def nobody_to_match(): return [
 ]
 
 
+@randomised
+def match_timed_out(): return [
+    "Matching took too long, sorry! Try again in a bit",
+    "Arf... ran out of time matching, try again soon!",
+]
+
+
 @randomised
 def generated_groups(g): return [
     f"Roger! I've generated example groups for ya:\n\n{g}",
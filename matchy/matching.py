@@ -1,10 +1,16 @@
 """Utility functions for matchy"""
+import concurrent.futures
 import logging
 import discord
+import itertools
+import random
+import time
+from bisect import bisect_left
+from collections import deque
 from datetime import datetime
 from typing import Protocol, runtime_checkable
-import matchy.util as util
 import matchy.state as state
+from matchy.blossom import max_weight_matching
 
 
 class _ScoreFactors(int):
@@ -27,6 +33,16 @@ class _ScoreFactors(int):
 logger = logging.getLogger("matching")
 logger.setLevel(logging.INFO)
 
+# Pairing every matchee optimally needs every possible pair in memory, so cap the channel size for it
+_PAIRS_MAX_MATCHEES = 1000
+
+# Budget for improving matched channel groups with local search
+_LOCAL_SEARCH_ITERATIONS = 2000
+_LOCAL_SEARCH_SECONDS = 1.0
+
+# Number of rotations each worker process tries at a time when matching in parallel
+_PARALLEL_BATCH_SIZE = 16
+
 
 @runtime_checkable
 class Role(Protocol):
@@ -65,6 +81,30 @@ class Guild(Protocol):
         pass
 
 
+class MatchStats():
+    """Stats on how a run of members_to_groups went"""
+
+    def __init__(self):
+        # Number of full attempts at creating groups
+        self.attempts = 0
+        # Number of times a matchee was scored against a group
+        self.scores = 0
+        # Wall time taken in seconds
+        self.seconds = 0.0
+        # Whether the time budget ran out before the search finished
+        self.timed_out = False
+        # Whether the simple fallback groups were used
+        self.fell_back = False
+        # Total score of the groups before and after any local search
+        self.score_before: int | None = None
+        self.score_after: int | None = None
+
+
+def _expired(deadline: float | None) -> bool:
+    """Check if a time.monotonic() deadline has passed"""
+    return deadline is not None and time.monotonic() > deadline
+
+
 def get_member_group_eligibility_score(member: Member,
                                        group: list[Member],
                                        prior_matches: list[int],
@@ -94,87 +134,588 @@ def get_member_group_eligibility_score(member: Member,
     return rating
 
 
-def attempt_create_groups(matchees: list[Member],
-                          oldest_relevant_ts: datetime,
-                          per_group: int) -> tuple[bool, list[list[Member]]]:
-    """History aware group matching"""
-    num_groups = max(len(matchees)//per_group, 1)
+class _Group():
+    """
+    A group of matchee indices being built up
+    Keeps running totals so scoring a matchee against it doesn't need to walk every member
+    """
+    __slots__ = ("members", "member_set", "roles", "size", "_role_masks")
+
+    def __init__(self, role_masks: list[int]):
+        self.members: list[int] = []
+        self.member_set: set[int] = set()
+        # Bitmask of every role held by anyone in the group
+        self.roles = 0
+        self.size = 0
+        # The role bitmask of every matchee, by index
+        self._role_masks = role_masks
+
+    def append(self, i: int):
+        """Add a matchee to the group"""
+        self.members.append(i)
+        self.member_set.add(i)
+        self.roles |= self._role_masks[i]
+        self.size += 1
+
+    def remove(self, i: int):
+        """Take a matchee back out of the group"""
+        self.members.remove(i)
+        self.member_set.discard(i)
+        self.roles = 0
+        for j in self.members:
+            self.roles |= self._role_masks[j]
+        self.size -= 1
+
+
+class _HistoryIndex():
+    """
+    Match history between a set of matchees, gathered once per matching run
+    Each matchee's partners are held sorted by when they last matched, as epoch integers
+    Matchees are referred to by their index in the list the index was built from
+    """
+
+    def __init__(self, matchees: list[Member]):
+        # Matchee IDs can repeat, so track every index each ID is found at
+        indices: dict[int, list[int]] = {}
+        for i, m in enumerate(matchees):
+            indices.setdefault(m.id, []).append(i)
+
+        # The state's history is already sorted by time, so only needs narrowing down to the matchees
+        self.times: list[list[int]] = []
+        self.partners: list[list[int]] = []
+        for m in matchees:
+            met = [(ts, j) for (ts, id) in state.State.get_user_match_history(m.id) for j in indices.get(id, ())]
+            self.times.append([t for (t, _) in met])
+            self.partners.append([j for (_, j) in met])
+
+    def timestamps(self) -> list[int]:
+        """Get every distinct time the matchees matched with each other, oldest first"""
+        return sorted(set(itertools.chain.from_iterable(self.times)))
+
+    def partners_since(self, i: int, oldest_relevant_ts: int) -> list[int]:
+        """Get the matchees a matchee has matched with since the given epoch time"""
+        return self.partners[i][bisect_left(self.times[i], oldest_relevant_ts):]
+
+
+class _PenaltyMatrix():
+    """
+    Pairwise penalty lookups between a set of matchees, built once per matching run
+    Matchees are referred to by their index in the list the matrix was built from
+    """
 
-    # Set up the groups in place
-    groups = [[] for _ in range(num_groups)]
+    def __init__(self, matchees: list[Member]):
+        # Map each role ID onto a bit so each matchee's roles can be held as a bitmask
+        bits: dict[int, int] = {}
+        self.roles: list[int] = []
+        for m in matchees:
+            mask = 0
+            for r in m.roles:
+                mask |= 1 << bits.setdefault(r.id, len(bits))
+            self.roles.append(mask)
+        # When each matchee last matched with each other matchee
+        self.history = _HistoryIndex(matchees)
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def prior_matches(self, oldest_relevant_ts: int) -> list[frozenset[int]]:
+        """Get the set of matchees each matchee has matched with since the given epoch time"""
+        return [frozenset(self.history.partners_since(i, oldest_relevant_ts))
+                for i in range(len(self))]
+
+    def score(self, i: int, group: _Group, prior_matches: frozenset[int], per_group: int) -> int:
+        """
+        Rates a matchee against a group of matchees
+        Equivalent to get_member_group_eligibility_score
+        """
+        # An empty group is a "perfect" score atomatically
+        rating = 0
+        if not group.size:
+            return rating
+
+        # Add score based on prior matchups of this user
+        num_prior = len(prior_matches & group.member_set)
+        rating += num_prior * _ScoreFactors.REPEAT_MATCH
+
+        # Calculate the number of roles that match
+        repeat_roles = (self.roles[i] & group.roles).bit_count()
+        rating += repeat_roles * _ScoreFactors.REPEAT_ROLE
+
+        # Add score based on the number of extra members
+        # Calculate the member offset (+1 for this user)
+        extra_members = (group.size - per_group) + 1
+        if extra_members >= 0:
+            rating += extra_members * _ScoreFactors.EXTRA_MEMBER
 
-    matchees_left = matchees.copy()
+        return rating
+
+    def group_score(self, group: _Group, prior_matches: list[frozenset[int]], per_group: int) -> int:
+        """
+        Rates a whole group, as the total score of each member against the rest of the group
+        Equivalent to summing score for every member of the group
+        """
+        rating = 0
+        if group.size <= 1:
+            return rating
+
+        num_prior = sum(len(prior_matches[i] & group.member_set) for i in group.members)
+        rating += num_prior * _ScoreFactors.REPEAT_MATCH
+
+        # Only count each member's roles that someone else in the group has too,
+        # which are exactly the ones held by more than one member
+        (seen, shared) = (0, 0)
+        for i in group.members:
+            shared |= seen & self.roles[i]
+            seen |= self.roles[i]
+        repeat_roles = sum((self.roles[i] & shared).bit_count() for i in group.members)
+        rating += repeat_roles * _ScoreFactors.REPEAT_ROLE
+
+        extra_members = group.size - per_group
+        if extra_members >= 0:
+            rating += group.size * extra_members * _ScoreFactors.EXTRA_MEMBER
+
+        return rating
+
+
+def _attempt_create_groups(penalties: _PenaltyMatrix,
+                           order: list[int],
+                           prior_matches: list[frozenset[int]],
+                           per_group: int,
+                           deadline: float | None = None,
+                           stats: MatchStats | None = None) -> list[list[int]] | None:
+    """
+    History aware group matching on matchee indices
+    Gives up if the deadline passes before all the matchees are placed
+    """
+    num_groups = max(len(order)//per_group, 1)
+
+    # Set up the groups in place, held as arrays so a matchee can be scored against all of them at once
+    groups: list[list[int]] = [[] for _ in range(num_groups)]
+    group_roles = [0] * num_groups
+    group_sizes = [0] * num_groups
+    # The group each matchee has been placed in, if any
+    placed = [-1] * len(penalties)
+
+    # The extra member penalty for joining a group of each size, with empty groups being "perfect"
+    extra_scores = [0] + [max(size - per_group + 1, 0) * _ScoreFactors.EXTRA_MEMBER
+                          for size in range(1, len(order))]
+
+    matchees_left = order.copy()
 
     # Sequentially try and fit each matchee into a group
     while matchees_left:
+        if _expired(deadline):
+            return None
+
         # Get the next matchee to place
         matchee = matchees_left.pop()
-        matchee_matches = state.State.get_user_matches(matchee.id)
-        relevant_matches = [int(id) for id, ts
-                            in matchee_matches.items()
-                            if state.ts_to_datetime(ts) >= oldest_relevant_ts]
-
-        # Try every single group from the current group onwards
-        # Progressing through the groups like this ensures we slowly fill them up with compatible people
-        scores: list[tuple[int, float]] = []
+        roles = penalties.roles[matchee]
+
+        # Count this matchee's prior matchups already placed in each group
+        group_priors = [0] * num_groups
+        for j in prior_matches[matchee]:
+            if placed[j] >= 0:
+                group_priors[placed[j]] += 1
+
+        # Score the matchee against every group
+        if stats:
+            stats.scores += num_groups
+        scores = [prior * _ScoreFactors.REPEAT_MATCH
+                  + (roles & group_role).bit_count() * _ScoreFactors.REPEAT_ROLE
+                  + extra_scores[size]
+                  for (prior, group_role, size) in zip(group_priors, group_roles, group_sizes)]
+
+        # Pick the first of the lowest scoring groups, as long as the score isn't too high
+        best = min(scores)
+        if best > _ScoreFactors.UPPER_THRESHOLD:
+            # If we failed to add this matchee, bail on the group creation as it could not be done
+            return None
+
+        g = scores.index(best)
+        groups[g].append(matchee)
+        group_roles[g] |= roles
+        group_sizes[g] += 1
+        placed[matchee] = g
+
+    return groups
+
+
+def _indices_to_members(matchees: list[Member], groups: list[list[int]] | None) -> list[list[Member]] | None:
+    """Convert groups of matchee indices back into groups of matchees"""
+    if groups is None:
+        return None
+    return [[matchees[i] for i in group] for group in groups]
+
+
+def attempt_create_groups(matchees: list[Member],
+                          oldest_relevant_ts: datetime,
+                          per_group: int) -> tuple[bool, list[list[Member]]]:
+    """History aware group matching"""
+    penalties = _PenaltyMatrix(matchees)
+    groups = _attempt_create_groups(penalties,
+                                    list(range(len(matchees))),
+                                    penalties.prior_matches(state.datetime_to_epoch(oldest_relevant_ts)),
+                                    per_group)
+    return _indices_to_members(matchees, groups)
+
+
+def _improve_groups(penalties: _PenaltyMatrix,
+                    groups: list[list[int]],
+                    prior_matches: list[frozenset[int]],
+                    per_group: int,
+                    iterations: int,
+                    deadline: float | None = None,
+                    stats: MatchStats | None = None) -> tuple[list[list[int]], int, int]:
+    """
+    Hill climb from a set of groups by moving and swapping matchees between them
+    Only changes that lower the total score are kept, and group sizes are kept within bounds
+    Returns the improved groups along with the total score before and after
+    """
+    built: list[_Group] = []
+    for members in groups:
+        group = _Group(penalties.roles)
+        for i in members:
+            group.append(i)
+        built.append(group)
+
+    scores = [penalties.group_score(g, prior_matches, per_group) for g in built]
+    before = sum(scores)
+    if len(built) < 2:
+        return (groups, before, before)
+
+    # Use a fixed seed so the same input always gives the same groups
+    rand = random.Random(0)
+
+    for _ in range(iterations):
+        if _expired(deadline):
+            break
+
+        (a, b) = rand.sample(range(len(built)), 2)
+        (group_a, group_b) = (built[a], built[b])
+        i = rand.choice(group_a.members)
+
+        # Either move the matchee over, or swap it with one from the other group
+        j = None
+        if not (group_a.size > per_group and group_b.size + 1 < per_group*2 and rand.random() < 0.5):
+            j = rand.choice(group_b.members)
+            group_b.remove(j)
+            group_a.append(j)
+        group_a.remove(i)
+        group_b.append(i)
+
+        score_a = penalties.group_score(group_a, prior_matches, per_group)
+        score_b = penalties.group_score(group_b, prior_matches, per_group)
+        if stats:
+            stats.scores += group_a.size + group_b.size
+        if score_a + score_b < scores[a] + scores[b]:
+            (scores[a], scores[b]) = (score_a, score_b)
+            continue
+
+        # Put everything back where it was
+        group_b.remove(i)
+        group_a.append(i)
+        if j is not None:
+            group_a.remove(j)
+            group_b.append(j)
+
+    return ([g.members for g in built], before, sum(scores))
+
+
+def _match_pairs(penalties: _PenaltyMatrix,
+                 deadline: float | None = None,
+                 stats: MatchStats | None = None) -> list[list[int]]:
+    """
+    Pair up matchees optimally, as a minimum cost perfect matching over every possible pair
+    Prior matches cost more the more recent they were, so the latest pairings are the most strongly avoided
+    Any odd matchee out is added to whichever pair suits them best
+    """
+    num_matchees = len(penalties)
+    if num_matchees < 2:
+        return [list(range(num_matchees))] if num_matchees else []
+
+    # Rank each distinct match time, with the most recent ranked highest
+    recency = {ts: rank for (rank, ts) in enumerate(penalties.history.timestamps(), 1)}
+    met = [{j: recency[ts] for (ts, j) in zip(times, partners)}
+           for (times, partners) in zip(penalties.history.times, penalties.history.partners)]
+
+    costs = []
+    for i in range(num_matchees):
+        for j in range(i + 1, num_matchees):
+            cost = (penalties.roles[i] & penalties.roles[j]).bit_count() * _ScoreFactors.REPEAT_ROLE
+            cost += met[i].get(j, 0) * _ScoreFactors.REPEAT_MATCH
+            costs.append((i, j, cost))
+    if stats:
+        stats.scores += len(costs)
+
+    # Every maximum cardinality matching has the same number of pairs,
+    # so maximising the inverted weights minimises the total cost
+    top = max(cost for (_, _, cost) in costs) + 1
+    mate = max_weight_matching([(i, j, top - cost) for (i, j, cost) in costs],
+                               max_cardinality=True, deadline=deadline)
+    groups = [[i, j] for (i, j) in enumerate(mate) if j > i]
+
+    # Pair up anyone left over if we ran out of time, in order
+    single = [i for (i, j) in enumerate(mate) if j == -1]
+    groups += [single[k:k + 2] for k in range(0, len(single) - 1, 2)]
+
+    # Fold an odd matchee out into the pair they score best against
+    if len(single) % 2:
+        i = single[-1]
+        prior_matches = frozenset(met[i])
+        scores = []
         for group in groups:
+            built = _Group(penalties.roles)
+            for j in group:
+                built.append(j)
+            scores.append(penalties.score(i, built, prior_matches, 2))
+        groups[scores.index(min(scores))].append(i)
+
+    return groups
+
+
+def _attempt_shifts(penalties: _PenaltyMatrix,
+                    shifts: range,
+                    prior_matches: list[frozenset[int]],
+                    per_group: int,
+                    deadline: float | None = None,
+                    stats: MatchStats | None = None) -> tuple[bool, list[list[int]] | None]:
+    """
+    Try to match groups starting with each of a range of matchees in turn
+    Returns whether a match was found, and the groups
+    Stops early without a match if the deadline passes
+    """
+    num_groups = len(penalties)//per_group
+    indices = list(range(len(penalties)))
 
-            score = get_member_group_eligibility_score(
-                matchee, group, relevant_matches, per_group)
+    for shift in shifts:
+        if _expired(deadline):
+            break
 
-            # If the score isn't too high, consider this group
-            if score <= _ScoreFactors.UPPER_THRESHOLD:
-                scores.append((group, score))
+        if stats:
+            stats.attempts += 1
+        groups = _attempt_create_groups(
+            penalties, indices[shift:] + indices[:shift], prior_matches, per_group, deadline, stats)
 
-            # Optimisation:
-            # A score of 0 means we've got something good enough and can skip
-            if score == 0:
+        # Fail the match if our groups aren't big enough
+        if num_groups <= 1 or (groups and all(len(g) >= per_group for g in groups)):
+            return (True, groups)
+
+    return (False, None)
+
+
+# The penalties for the current run, shipped once to each worker process when matching in parallel
+_worker_penalties: _PenaltyMatrix | None = None
+# The last history cutoff a worker process used, along with the prior matches for it
+_worker_prior_matches: tuple[int, list[frozenset[int]]] | None = None
+
+
+def _init_worker(penalties: _PenaltyMatrix):
+    """Set up a worker process with the penalties for the current run"""
+    global _worker_penalties, _worker_prior_matches
+    _worker_penalties = penalties
+    _worker_prior_matches = None
+
+
+def _worker_attempt_shifts(oldest_relevant_ts: int,
+                           per_group: int,
+                           start: int,
+                           stop: int,
+                           deadline: float | None) -> tuple[bool, list[list[int]] | None, int, int]:
+    """
+    Try to match groups for a batch of rotations in a worker process
+    Returns whether a match was found, the groups, and the attempts and scores it took
+    """
+    global _worker_prior_matches
+    if _worker_prior_matches is None or _worker_prior_matches[0] != oldest_relevant_ts:
+        _worker_prior_matches = (oldest_relevant_ts, _worker_penalties.prior_matches(oldest_relevant_ts))
+
+    stats = MatchStats()
+    (matched, groups) = _attempt_shifts(_worker_penalties, range(start, stop),
+                                        _worker_prior_matches[1], per_group, deadline, stats)
+    return (matched, groups, stats.attempts, stats.scores)
+
+
+def _match_at_cutoff_parallel(executor: concurrent.futures.ProcessPoolExecutor,
+                              processes: int,
+                              penalties: _PenaltyMatrix,
+                              oldest_relevant_ts: int,
+                              per_group: int,
+                              deadline: float | None = None,
+                              stats: MatchStats | None = None) -> tuple[bool, list[list[int]] | None]:
+    """
+    Try to match groups ignoring any history before the cutoff, with batches of rotations tried across processes
+    Batches are read back in order, so the result is always the same as trying each rotation in turn
+    """
+    batches = iter(range(0, len(penalties), _PARALLEL_BATCH_SIZE))
+    pending: deque[concurrent.futures.Future] = deque()
+
+    def submit():
+        start = next(batches, None)
+        if start is not None:
+            stop = min(start + _PARALLEL_BATCH_SIZE, len(penalties))
+            pending.append(executor.submit(
+                _worker_attempt_shifts, oldest_relevant_ts, per_group, start, stop, deadline))
+
+    # Keep a couple of batches queued up for each process, so none sit idle
+    for _ in range(processes * 2):
+        submit()
+
+    try:
+        while pending:
+            (matched, groups, attempts, scores) = pending.popleft().result()
+            if stats:
+                stats.attempts += attempts
+                stats.scores += scores
+
+            # Every earlier batch has already failed, so this is the first match in order
+            if matched:
+                return (True, groups)
+            if _expired(deadline):
                 break
+            submit()
 
-        if scores:
-            (group, _) = sorted(scores, key=lambda pair: pair[1])[0]
-            group.append(matchee)
-        else:
-            # If we failed to add this matchee, bail on the group creation as it could not be done
-            return None
+    finally:
+        # Drop any later batches that haven't started yet
+        for future in pending:
+            future.cancel()
 
-    return groups
+    return (False, None)
+
+
+def _match_at_cutoff(penalties: _PenaltyMatrix,
+                     oldest_relevant_ts: int,
+                     per_group: int,
+                     deadline: float | None = None,
+                     stats: MatchStats | None = None,
+                     executor: concurrent.futures.ProcessPoolExecutor | None = None,
+                     processes: int = 0) -> tuple[bool, list[list[int]] | None]:
+    """
+    Try to match groups ignoring any history before the cutoff, starting with each matchee in turn
+    Returns whether a match was found, and the groups
+    Stops early without a match if the deadline passes
+    """
+    if executor:
+        return _match_at_cutoff_parallel(executor, processes, penalties, oldest_relevant_ts,
+                                         per_group, deadline, stats)
+
+    return _attempt_shifts(penalties, range(len(penalties)), penalties.prior_matches(oldest_relevant_ts),
+                           per_group, deadline, stats)
 
 
 def members_to_groups(matchees: list[Member],
                       per_group: int = 3,
-                      allow_fallback: bool = False) -> list[list[Member]]:
-    """Generate the groups from the set of matchees"""
-    attempts = 0  # Tracking for logging purposes
+                      allow_fallback: bool = False,
+                      bisect_history: bool = False,
+                      local_search: int = 0,
+                      local_search_seconds: float | None = None,
+                      timeout: float | None = None,
+                      stats: MatchStats | None = None,
+                      processes: int = 0,
+                      penalties: _PenaltyMatrix | None = None) -> list[list[Member]]:
+    """
+    Generate the groups from the set of matchees
+    Pairs are matched optimally on all but the largest channels, while larger groups are searched for
+    With bisect_history the history cutoff is binary searched for rather than walked, taking far fewer attempts,
+    but a newer cutoff failing to match doesn't mean every older one does, so it can settle on less history
+    With more than one process the starting rotations are tried in parallel, giving the same groups
+    With local_search the matched groups are then improved for up to that many iterations,
+    optionally stopping early after local_search_seconds
+    With a timeout in seconds the best groups found so far are returned once it runs out,
+    or the simple fallback groups if none were found
+    Any stats passed in are filled in with how the run went
+    Penalties already built for the matchees can be passed in, in which case the state isn't read at all
+    """
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    if stats is None:
+        stats = MatchStats()
     num_groups = len(matchees)//per_group
 
     # Bail early if there's no-one to match
     if not matchees:
         return []
 
-    # Walk from the start of history until now trying to match up groups
-    for oldest_relevant_datetime in state.State.get_history_timestamps(matchees) + [datetime.now()]:
-
-        # Attempt with each starting matchee
-        for shifted_matchees in util.iterate_all_shifts(matchees):
-
-            attempts += 1
-            groups = attempt_create_groups(
-                shifted_matchees, oldest_relevant_datetime, per_group)
+    # Build up the penalties between every pair of matchees once up front
+    if penalties is None:
+        penalties = _PenaltyMatrix(matchees)
+
+    # Pairs can be matched optimally, so there's no need to search
+    if per_group == 2 and len(matchees) <= _PAIRS_MAX_MATCHEES:
+        groups = _indices_to_members(matchees, _match_pairs(penalties, deadline, stats))
+        stats.attempts = 1
+        stats.timed_out = _expired(deadline)
+        stats.seconds = time.monotonic() - start
+        logger.info("Matched pairs in %.2fs", stats.seconds)
+        return groups
+
+    cutoffs = penalties.history.timestamps() + [state.datetime_to_epoch(datetime.now())]
+    (matched, groups, cutoff) = (False, None, None)
+
+    # Only bother with worker processes when there's more than the one rotation to try
+    executor = None
+    if processes > 1 and num_groups > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=_init_worker, initargs=(penalties,))
+
+    try:
+        if bisect_history:
+            # Ignoring more history usually makes matching easier, so search for an old cutoff that matches
+            (lo, hi) = (0, len(cutoffs))
+            while lo < hi and not _expired(deadline):
+                mid = (lo + hi) // 2
+                (mid_matched, mid_groups) = _match_at_cutoff(
+                    penalties, cutoffs[mid], per_group, deadline, stats, executor, processes)
+                if mid_matched:
+                    (matched, groups, cutoff) = (True, mid_groups, cutoffs[mid])
+                    hi = mid
+                elif not _expired(deadline):
+                    lo = mid + 1
 
-            # Fail the match if our groups aren't big enough
-            if num_groups <= 1 or (groups and all(len(g) >= per_group for g in groups)):
-                logger.info("Matched groups after %s attempt(s)", attempts)
-                return groups
+        else:
+            # Walk from the start of history until now trying to match up groups
+            for oldest_relevant_ts in cutoffs:
+                (matched, groups) = _match_at_cutoff(
+                    penalties, oldest_relevant_ts, per_group, deadline, stats, executor, processes)
+                if matched:
+                    cutoff = oldest_relevant_ts
+                    break
+                if _expired(deadline):
+                    break
+
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    stats.timed_out = _expired(deadline)
+
+    if matched:
+        logger.info("Matched groups after %s attempt(s)", stats.attempts)
+        if groups and local_search:
+            search_deadline = time.monotonic() + local_search_seconds if local_search_seconds is not None else None
+            if deadline is not None and (search_deadline is None or deadline < search_deadline):
+                search_deadline = deadline
+            (groups, stats.score_before, stats.score_after) = _improve_groups(
+                penalties, groups, penalties.prior_matches(cutoff), per_group,
+                local_search, search_deadline, stats)
+            logger.info("Local search improved score from %s to %s",
+                        stats.score_before, stats.score_after)
+        groups = _indices_to_members(matchees, groups)
 
     # If we've still failed, just use the simple method
-    if allow_fallback:
-        logger.info("Fell back to simple groups after %s attempt(s)", attempts)
-        return [matchees[i::num_groups] for i in range(num_groups)]
-
-    # Simply assert false, this should never happen
-    # And should be caught by tests
-    assert False
+    elif allow_fallback or stats.timed_out:
+        logger.info("Fell back to simple groups after %s attempt(s)", stats.attempts)
+        stats.fell_back = True
+        groups = [matchees[i::num_groups] for i in range(num_groups)]
+
+    else:
+        # Simply assert false, this should never happen
+        # And should be caught by tests
+        assert False
+
+    stats.seconds = time.monotonic() - start
+    if stats.timed_out:
+        logger.info("Ran out of time matching groups after %.2fs", stats.seconds)
+    return groups
 
 
 def get_matchees_in_channel(channel: discord.channel):
@@ -182,16 +723,45 @@ def get_matchees_in_channel(channel: discord.channel):
     # Reactivate any unpaused users
     state.State.reactivate_users(channel.id)
     # Gather up the prospective matchees
-    active = [m for m in channel.members if state.State.get_user_active_in_channel(
-        m.id, channel.id)]
-    paused = [m for m in channel.members if state.State.get_user_paused_in_channel(
-        m.id, channel.id)]
+    active_ids = state.State.get_active_users_in_channel(channel.id)
+    paused_ids = state.State.get_paused_users_in_channel(channel.id)
+    (active, paused) = ([], [])
+    for m in channel.members:
+        if str(m.id) in active_ids:
+            active.append(m)
+        if str(m.id) in paused_ids:
+            paused.append(m)
     return (active, paused)
 
 
-def active_members_to_groups(channel: discord.channel, min_members: int):
-    """Helper to create groups from channel members"""
-    # Gather up the prospective matchees
+def snapshot_active_members(channel: discord.channel) -> tuple[list[Member], _PenaltyMatrix]:
+    """
+    Gather up the active members of a channel along with the penalties between them
+    This reads and updates the state, so should be done on the event loop
+    """
     (matchees, _) = get_matchees_in_channel(channel)
-    # Create our groups!
-    return members_to_groups(matchees, min_members, allow_fallback=True)
+    return (matchees, _PenaltyMatrix(matchees))
+
+
+def snapshot_to_groups(snapshot: tuple[list[Member], _PenaltyMatrix],
+                       min_members: int,
+                       timeout: float | None = None,
+                       stats: MatchStats | None = None) -> list[list[Member]]:
+    """
+    Create groups from a snapshot of channel members
+    This doesn't touch the state, so is safe to run on another thread
+    """
+    (matchees, penalties) = snapshot
+    # The history is walked rather than bisected, so as much of it is used as possible
+    return members_to_groups(matchees, min_members, allow_fallback=True,
+                             local_search=_LOCAL_SEARCH_ITERATIONS,
+                             local_search_seconds=_LOCAL_SEARCH_SECONDS,
+                             timeout=timeout, stats=stats, penalties=penalties)
+
+
+def active_members_to_groups(channel: discord.channel,
+                             min_members: int,
+                             timeout: float | None = None,
+                             stats: MatchStats | None = None):
+    """Helper to create groups from channel members"""
+    return snapshot_to_groups(snapshot_active_members(channel), min_members, timeout, stats)
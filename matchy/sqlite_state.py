@@ -0,0 +1,430 @@
+"""
+Store bot state in an SQLite database
+Implements the same API as the JSON state, but with indexed tables rather than one big dict
+Only the rows a read or write needs are touched, so it scales with the number of users and matches
+"""
+import os
+import json
+import pathlib
+import sqlite3
+import itertools
+import logging
+from collections.abc import Generator
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import matchy.state as state
+from matchy.state import Member, epoch_to_datetime, datetime_to_epoch
+
+logger = logging.getLogger("sqlite_state")
+logger.setLevel(logging.INFO)
+
+# Warning: Changing the tables needs a migration, the same as the JSON state
+_DB_VERSION = 3
+
+# Strict tables reject values of the wrong type, as the JSON schema does
+_CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY
+) STRICT;
+
+CREATE TABLE IF NOT EXISTS scopes (
+    user INTEGER NOT NULL,
+    scope TEXT NOT NULL,
+    PRIMARY KEY (user, scope)
+) STRICT, WITHOUT ROWID;
+
+-- Each match is stored in both directions
+CREATE TABLE IF NOT EXISTS matches (
+    user INTEGER NOT NULL,
+    other INTEGER NOT NULL,
+    ts TEXT NOT NULL,
+    PRIMARY KEY (user, other)
+) STRICT, WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS channels (
+    user INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    reactivate TEXT,
+    PRIMARY KEY (user, channel)
+) STRICT, WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channels_active ON channels (channel) WHERE active;
+CREATE INDEX IF NOT EXISTS channels_paused ON channels (channel, reactivate) WHERE reactivate IS NOT NULL;
+
+-- Tasks keep the order they were added in by rowid
+CREATE TABLE IF NOT EXISTS tasks (
+    channel INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    members_min INTEGER NOT NULL,
+    UNIQUE (channel, weekday, hour)
+) STRICT;
+CREATE INDEX IF NOT EXISTS tasks_time ON tasks (weekday, hour);
+"""
+
+# Converts a v1 timestamp into epoch microseconds
+_EPOCH_SQL = "CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 + CAST(substr({0}, 21) AS INTEGER)"
+
+# v2 stored each match once per pair, and times as epochs, the same as v5 of the JSON state
+_MIGRATE_TO_V2 = f"""
+CREATE TABLE pairs (
+    low INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (low, high)
+) STRICT, WITHOUT ROWID;
+CREATE INDEX pairs_high ON pairs (high);
+INSERT INTO pairs (low, high, ts)
+    SELECT min(user, other), max(user, other), max({_EPOCH_SQL.format("ts")}) FROM matches GROUP BY 1, 2;
+DROP TABLE matches;
+
+CREATE TABLE channels_v2 (
+    user INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    reactivate INTEGER,
+    PRIMARY KEY (user, channel)
+) STRICT, WITHOUT ROWID;
+INSERT INTO channels_v2 SELECT user, channel, active, {_EPOCH_SQL.format("reactivate")} FROM channels;
+DROP TABLE channels;
+ALTER TABLE channels_v2 RENAME TO channels;
+CREATE INDEX channels_active ON channels (channel) WHERE active;
+CREATE INDEX channels_paused ON channels (channel, reactivate) WHERE reactivate IS NOT NULL;
+"""
+
+# v3 added the archive of match history moved out of pairs by the retention policy
+_MIGRATE_TO_V3 = """
+CREATE TABLE archive (
+    low INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (low, high)
+) STRICT, WITHOUT ROWID;
+CREATE INDEX archive_high ON archive (high);
+"""
+
+# Scripts to apply in turn to bring the tables up to each version
+_MIGRATIONS = [
+    _CREATE_TABLES,
+    _MIGRATE_TO_V2,
+    _MIGRATE_TO_V3,
+]
+
+
+class _SqliteState():
+    def __init__(self, file: str = ":memory:", import_from: str | None = None):
+        """
+        Open the database, creating the tables if needed
+        A new database is filled from the JSON state file to import from, if there is one
+        """
+        if file != ":memory:":
+            pathlib.Path(os.path.dirname(file) or ".").mkdir(parents=True, exist_ok=True)
+        self._file = file
+        # Transactions are managed explicitly, see transaction
+        self._db = sqlite3.connect(file, isolation_level=None)
+        self._retention: tuple[timedelta | None, int | None] = (None, None)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version > _DB_VERSION:
+            raise RuntimeError(f"Database {file} is v{version}, newer than the supported v{_DB_VERSION}")
+        if version < _DB_VERSION:
+            # Only marked as up to date once everything's done, so a failed migration or import is tried again
+            with self.transaction():
+                for i in range(version, _DB_VERSION):
+                    logger.info("Migrating database from v%s to v%s", i, i + 1)
+                    for statement in _MIGRATIONS[i].split(";"):
+                        self._db.execute(statement)
+                if version == 0 and import_from and os.path.isfile(import_from):
+                    import_from_json(self, import_from)
+                self._db.execute(f"PRAGMA user_version = {_DB_VERSION}")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group any number of writes into one, for use as a context manager
+        Rolls every change back if anything fails, and joins any transaction already open
+        """
+        if self._db.in_transaction:
+            yield
+            return
+
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    safe_write = staticmethod(state._State.safe_write)
+
+    def _add_users(self, ids: list):
+        """Make sure each user has a row"""
+        self._db.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)", ((int(id),) for id in ids))
+
+    def get_history_timestamps(self, users: list[Member]) -> list[datetime]:
+        """Grab all timestamps in the history"""
+        return [epoch_to_datetime(ts) for ts in self.get_history_times(m.id for m in users)]
+
+    def get_history_times(self, ids: list[int]) -> list[int]:
+        """Get every distinct epoch time the given users matched with each other, oldest first"""
+        rows = self._db.execute(
+            """
+            WITH ids(id) AS (SELECT DISTINCT value FROM json_each(?))
+            SELECT DISTINCT ts FROM ids JOIN pairs ON pairs.low = ids.id
+            WHERE pairs.high IN ids
+            ORDER BY ts
+            """, (json.dumps([int(id) for id in ids]),))
+        return [ts for (ts,) in rows]
+
+    def get_user_matches(self, id: int) -> dict[int, int]:
+        """Get each user a user has matched with, and the epoch time they last matched"""
+        rows = self._db.execute(
+            "SELECT high, ts FROM pairs WHERE low = ? UNION ALL SELECT low, ts FROM pairs WHERE high = ?",
+            (int(id), int(id)))
+        return dict(rows)
+
+    def get_user_match_history(self, id: int) -> list[tuple[int, int]]:
+        """Get the epoch time a user last matched with each partner, as (time, partner ID), oldest first"""
+        return self._db.execute(
+            "SELECT ts, high FROM pairs WHERE low = ?1 UNION ALL SELECT ts, low FROM pairs WHERE high = ?1 ORDER BY ts",
+            (int(id),)).fetchall()
+
+    def get_user_partners_since(self, id: int, ts: int) -> list[int]:
+        """Get the IDs of everyone a user has matched with at or after an epoch time"""
+        rows = self._db.execute(
+            """
+            SELECT other FROM (
+                SELECT high AS other, ts FROM pairs WHERE low = ?1 AND ts >= ?2
+                UNION ALL SELECT low, ts FROM pairs WHERE high = ?1 AND ts >= ?2
+            ) ORDER BY ts
+            """, (int(id), ts))
+        return [other for (other,) in rows]
+
+    def get_pair_matched(self, a: int, b: int) -> int | None:
+        """Get the epoch time a pair of users last matched, if they ever have"""
+        row = self._db.execute(
+            "SELECT ts FROM pairs WHERE low = min(?1, ?2) AND high = max(?1, ?2)", (int(a), int(b))).fetchone()
+        return row[0] if row else None
+
+    def get_user_full_matches(self, id: int) -> dict[int, int]:
+        """Get each user a user has ever matched with, and the epoch time they last matched, including the archive"""
+        rows = self._db.execute(
+            """
+            SELECT other, max(ts) FROM (
+                SELECT high AS other, ts FROM pairs WHERE low = ?1
+                UNION ALL SELECT low, ts FROM pairs WHERE high = ?1
+                UNION ALL SELECT high, ts FROM archive WHERE low = ?1
+                UNION ALL SELECT low, ts FROM archive WHERE high = ?1
+            ) GROUP BY other
+            """, (int(id),))
+        return dict(rows)
+
+    def set_retention(self, max_age: timedelta | None = None, max_partners: int | None = None):
+        """
+        Set how much match history to keep in the state, archiving anything older right away
+        Pairs are kept while they last matched within the max age, and are among both users' max partners most recent
+        """
+        self._retention = (max_age, max_partners)
+        self.archive_history()
+
+    def archive_history(self, now: datetime | None = None) -> int:
+        """Move any match history outside the retention policy into the archive, returning how many pairs moved"""
+        (max_age, max_partners) = self._retention
+        if max_age is None and max_partners is None:
+            return 0
+
+        oldest = datetime_to_epoch((now or datetime.now()) - max_age) if max_age is not None else None
+        with self.transaction():
+            self._db.execute("CREATE TEMP TABLE expired (low INTEGER, high INTEGER, PRIMARY KEY (low, high))")
+            if oldest is not None:
+                self._db.execute("INSERT OR IGNORE INTO expired SELECT low, high FROM pairs WHERE ts < ?", (oldest,))
+            if max_partners is not None:
+                self._db.execute(
+                    """
+                    INSERT OR IGNORE INTO expired SELECT low, high FROM (
+                        SELECT low, high, row_number() OVER (PARTITION BY user ORDER BY ts DESC) AS n FROM (
+                            SELECT low AS user, low, high, ts FROM pairs UNION ALL SELECT high, low, high, ts FROM pairs
+                        )
+                    ) WHERE n > ?
+                    """, (max_partners,))
+            self._db.execute(
+                """
+                INSERT INTO archive (low, high, ts) SELECT low, high, ts FROM pairs WHERE (low, high) IN expired
+                ON CONFLICT (low, high) DO UPDATE SET ts = excluded.ts
+                """)
+            count = self._db.execute("DELETE FROM pairs WHERE (low, high) IN expired").rowcount
+            self._db.execute("DROP TABLE expired")
+        if count:
+            logger.info("Archived %s pair(s) of match history", count)
+        return count
+
+    def _set_pairs(self, pairs):
+        """Record when each (ID, ID, epoch time) pair last matched"""
+        self._db.executemany(
+            """
+            INSERT INTO pairs (low, high, ts) VALUES (min(?1, ?2), max(?1, ?2), ?3)
+            ON CONFLICT (low, high) DO UPDATE SET ts = excluded.ts
+            """, pairs)
+
+    @safe_write
+    def log_groups(self, groups: list[list[Member]], ts: datetime = None) -> None:
+        """Log the groups"""
+        ts = datetime_to_epoch(ts or datetime.now())
+        self._add_users(m.id for group in groups for m in group)
+        self._set_pairs((m.id, o.id, ts) for group in groups for (m, o) in itertools.combinations(group, 2)
+                        if m.id != o.id)
+
+    @safe_write
+    def set_user_scope(self, id: str, scope: str, value: bool = True):
+        """Add an auth scope to a user"""
+        self._add_users([id])
+        if value:
+            self._db.execute("INSERT OR IGNORE INTO scopes (user, scope) VALUES (?, ?)", (int(id), scope))
+        else:
+            self._db.execute("DELETE FROM scopes WHERE user = ? AND scope = ?", (int(id), scope))
+
+    def get_user_has_scope(self, id: str, scope: str) -> bool:
+        """
+            Check if a user has an auth scope
+            "owner" users have all scopes
+        """
+        return self._db.execute(
+            "SELECT 1 FROM scopes WHERE user = ? AND scope = ?", (int(id), scope)).fetchone() is not None
+
+    def _set_channel(self, id: str, channel_id: str, active: bool, reactivate: str | None):
+        self._add_users([id])
+        self._db.execute(
+            """
+            INSERT INTO channels (user, channel, active, reactivate) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user, channel) DO UPDATE SET active = excluded.active, reactivate = excluded.reactivate
+            """, (int(id), int(channel_id), int(bool(active)), reactivate))
+
+    @safe_write
+    def set_user_active_in_channel(self, id: str, channel_id: str, active: bool = True):
+        """Set a user as active (or not) on a given channel"""
+        self._set_channel(id, channel_id, active, None)
+
+    @safe_write
+    def set_users_active_in_channel(self, ids: list[str], channel_id: str, active: bool = True):
+        """Set a set of users as active (or not) on a given channel"""
+        for id in ids:
+            self.set_user_active_in_channel(id, channel_id, active)
+
+    def get_user_active_in_channel(self, id: str, channel_id: str) -> bool:
+        """Get a if a user is active in a channel"""
+        row = self._db.execute(
+            "SELECT active FROM channels WHERE user = ? AND channel = ?", (int(id), int(channel_id))).fetchone()
+        return bool(row and row[0])
+
+    def get_user_paused_in_channel(self, id: str, channel_id: str) -> int:
+        """Get a the user reactivate epoch time if it exists"""
+        row = self._db.execute(
+            "SELECT reactivate FROM channels WHERE user = ? AND channel = ?", (int(id), int(channel_id))).fetchone()
+        return row[0] if row else None
+
+    def get_active_users_in_channel(self, channel_id: str) -> set[str]:
+        """Get the IDs of every user active in a channel"""
+        rows = self._db.execute("SELECT user FROM channels WHERE channel = ? AND active", (int(channel_id),))
+        return set(str(user) for (user,) in rows)
+
+    def get_paused_users_in_channel(self, channel_id: str) -> dict[str, int]:
+        """Get the IDs of every user paused in a channel, with their reactivate times"""
+        rows = self._db.execute(
+            "SELECT user, reactivate FROM channels WHERE channel = ? AND reactivate IS NOT NULL", (int(channel_id),))
+        return {str(user): ts for (user, ts) in rows}
+
+    @safe_write
+    def set_user_paused_in_channel(self, id: str, channel_id: str, until: datetime):
+        """Sets a user as inactive in a channel with a reactivation time"""
+        self._set_channel(id, channel_id, False, datetime_to_epoch(until))
+
+    @safe_write
+    def reactivate_users(self, channel_id: str):
+        """Reactivate any users who've passed their reactivation time on this channel"""
+        self._db.execute(
+            """
+            UPDATE channels SET active = 1, reactivate = NULL
+            WHERE channel = ? AND reactivate IS NOT NULL AND reactivate < ?
+            """, (int(channel_id), datetime_to_epoch(datetime.now())))
+
+    def get_active_match_tasks(self, time: datetime | None = None) -> Generator[str, int]:
+        """
+        Get any active match tasks at the given time
+        returns list of channel,members_min pairs
+        """
+        if not time:
+            time = datetime.now()
+        rows = self._db.execute(
+            "SELECT channel, members_min FROM tasks WHERE weekday = ? AND hour = ? ORDER BY rowid",
+            (time.weekday(), time.hour)).fetchall()
+        for (channel, members_min) in rows:
+            yield (str(channel), members_min)
+
+    def get_channel_match_tasks(self, channel_id: str) -> Generator[int, int, int]:
+        """
+        Get all match tasks for the channel
+        """
+        rows = self._db.execute(
+            "SELECT weekday, hour, members_min FROM tasks WHERE channel = ? ORDER BY rowid",
+            (int(channel_id),)).fetchall()
+        yield from rows
+
+    @safe_write
+    def set_channel_match_task(self, channel_id: str, members_min: int, weekday: int, hour: int):
+        """Set up a match task on a channel"""
+        self._db.execute(
+            """
+            INSERT INTO tasks (channel, weekday, hour, members_min) VALUES (?, ?, ?, ?)
+            ON CONFLICT (channel, weekday, hour) DO UPDATE SET members_min = excluded.members_min
+            """, (int(channel_id), weekday, hour, members_min))
+
+    @safe_write
+    def remove_channel_match_tasks(self, channel_id: str):
+        """Simply delete the match tasks"""
+        self._db.execute("DELETE FROM tasks WHERE channel = ?", (int(channel_id),))
+
+    def persist_in_background(self, delay: float, max_staleness: float):
+        """Nothing to do, as each write is committed to the database's own journal as it's made"""
+
+    def flush(self):
+        """Checkpoint the database's journal back into the database"""
+        self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        self._db.close()
+
+
+def import_from_json(st: _SqliteState, file: str):
+    """
+    Import everything from a JSON state file into the database, in one write
+    Run when a database is first created, see load_from_db
+    The file and any journal alongside are only read, and migrated up to date on the way in
+    """
+    loaded = state._load(file)
+    state._Journal(file).replay(loaded)
+    source = state._State(loaded)
+
+    with st.transaction():
+        st._add_users(source._users)
+        for id, user in source._users.items():
+            for scope in user.get(state._Key.SCOPES, []):
+                st.set_user_scope(id, scope)
+            for channel, data in user.get(state._Key.CHANNELS, {}).items():
+                st._set_channel(id, channel, data[state._Key.ACTIVE], data.get(state._Key.REACTIVATE))
+        st._set_pairs(source._matches)
+        for channel, tasks in source._tasks.items():
+            for task in tasks.get(state._Key.MATCH_TASKS, []):
+                st.set_channel_match_task(
+                    channel, task[state._Key.MEMBERS_MIN], task[state._Key.WEEKDAY], task[state._Key.HOUR])
+    logger.info("Imported %s user(s) from %s", len(source._users), file)
+
+
+def load_from_db(file: str, import_from: str | None = None) -> _SqliteState:
+    """
+    Load the state from a database
+    When the database is new, everything is imported from the JSON state file first, if there is one
+    """
+    return _SqliteState(file, import_from)
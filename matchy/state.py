@@ -1,22 +1,35 @@
 """Store bot state"""
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from schema import Schema, Use, Optional
-from collections.abc import Generator
+from collections.abc import Callable, Generator
 from typing import Protocol
 import json
 import shutil
 import pathlib
+import atexit
 import copy
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+import itertools
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from functools import wraps
 import matchy.util as util
+import matchy.validation as validation
 
 logger = logging.getLogger("state")
 logger.setLevel(logging.INFO)
 
 # Warning: Changing any of the below needs proper thought to ensure backwards compatibility
-_VERSION = 4
+_VERSION = 5
+
+# Compact the journal into a fresh snapshot once it holds this many writes or bytes
+_JOURNAL_MAX_ENTRIES = 1000
+_JOURNAL_MAX_BYTES = 1024 * 1024
 
 
 def _migrate_to_v1(d: dict):
@@ -64,12 +77,30 @@ def _migrate_to_v4(d: dict):
     del d[_Key._HISTORY]
 
 
+def _migrate_to_v5(d: dict):
+    """
+    v5 moved matches out of the users into one [low ID, high ID, epoch time] record per pair
+    Reactivate times also became epoch times
+    """
+    matches = {}
+    for id, user in d[_Key.USERS].items():
+        for other, ts in user.pop(_Key.MATCHES, {}).items():
+            pair = (min(int(id), int(other)), max(int(id), int(other)))
+            # Both directions should agree, but keep the latest just in case
+            matches[pair] = max(matches.get(pair, 0), ts_to_epoch(ts))
+        for channel in user.get(_Key.CHANNELS, {}).values():
+            if channel.get(_Key.REACTIVATE):
+                channel[_Key.REACTIVATE] = ts_to_epoch(channel[_Key.REACTIVATE])
+    d[_Key.MATCHES] = [[low, high, ts] for ((low, high), ts) in matches.items()]
+
+
 # Set of migration functions to apply
 _MIGRATIONS = [
     _migrate_to_v1,
     _migrate_to_v2,
     _migrate_to_v3,
     _migrate_to_v4,
+    _migrate_to_v5,
 ]
 
 
@@ -115,22 +146,21 @@ _SCHEMA = Schema(
             # User ID as string
             Optional(str): {
                 Optional(_Key.SCOPES): Use(list[str]),
-                Optional(_Key.MATCHES): {
-                    # Matchee ID and Datetime pair
-                    Optional(str): Use(str)
-                },
                 Optional(_Key.CHANNELS): {
                     # The channel ID
                     Optional(str): {
                         # Whether the user is signed up in this channel
                         _Key.ACTIVE: Use(bool),
-                        # A timestamp for when to re-activate the user
-                        Optional(_Key.REACTIVATE): Use(str),
+                        # An epoch time for when to re-activate the user
+                        Optional(_Key.REACTIVATE): Use(int),
                     }
                 }
             }
         },
 
+        # Every pair of users that have matched, as [low ID, high ID, epoch time of their last match]
+        Optional(_Key.MATCHES): [[Use(int)]],
+
         _Key.TASKS: {
             # Channel ID as string
             Optional(str): {
@@ -149,11 +179,15 @@ _SCHEMA = Schema(
 # Empty but schema-valid internal dict
 _EMPTY_DICT = {
     _Key.USERS: {},
+    _Key.MATCHES: [],
     _Key.TASKS: {},
     _Key.VERSION: _VERSION
 }
 assert _SCHEMA.validate(_EMPTY_DICT)
 
+# The schema compiled down, for validating quickly and validating just what's changed
+_VALIDATOR = validation.compile_schema(_SCHEMA)
+
 
 class Member(Protocol):
     @property
@@ -171,6 +205,24 @@ def datetime_to_ts(ts: datetime) -> str:
     return datetime.strftime(ts, _TIME_FORMAT)
 
 
+_EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_epoch(ts: datetime) -> int:
+    """Convert a datetime to integer microseconds since the epoch, keeping full precision"""
+    return (ts - _EPOCH) // timedelta(microseconds=1)
+
+
+def epoch_to_datetime(ts: int) -> datetime:
+    """Convert integer microseconds since the epoch to a datetime"""
+    return _EPOCH + timedelta(microseconds=ts)
+
+
+def ts_to_epoch(ts: str) -> int:
+    """Convert a string ts to integer microseconds since the epoch"""
+    return datetime_to_epoch(ts_to_datetime(ts))
+
+
 def _load(file: str) -> dict:
     """Load a json file directly as a dict"""
     with open(file) as f:
@@ -181,6 +233,38 @@ def _save(file: str, content: dict):
     """
     Save out a content dictionary to a file
     """
+    _write(file, _dumps(content))
+
+
+def _dumps(content: dict) -> str:
+    """
+    Serialise a content dictionary, indented to be readable
+    There are a lot of match records, so each is kept to a single line
+    """
+    content = dict(content)
+    matches = content.pop(_Key.MATCHES, None)
+    text = json.dumps(content, indent=4)
+    if matches is None:
+        return text
+    records = ",\n".join(f"        {json.dumps(m)}" for m in matches)
+    records = f"[\n{records}\n    ]" if records else "[]"
+    # Slot the records in before the closing brace
+    return f'{text[:-2]},\n    "{_Key.MATCHES}": {records}\n}}'
+
+
+def _copy_containers(content):
+    """Copy the dicts and lists in some content, sharing the values in them as they can't change"""
+    if isinstance(content, dict):
+        return {k: _copy_containers(v) for (k, v) in content.items()}
+    if isinstance(content, list):
+        return [_copy_containers(v) for v in content]
+    return content
+
+
+def _write(file: str, text: str):
+    """
+    Write out some text to a file, replacing it in one go
+    """
     # Ensure the save directory exists first
     dir = pathlib.Path(os.path.dirname(file))
     dir.mkdir(parents=True, exist_ok=True)
@@ -188,74 +272,804 @@ def _save(file: str, content: dict):
     # Store in an intermediary directory first
     intermediate = file + ".nxt"
     with open(intermediate, "w") as f:
-        json.dump(content, f, indent=4)
+        f.write(text)
     shutil.move(intermediate, file)
 
 
+def _apply(d: dict, pairs: dict, ops: list):
+    """
+    Apply journalled operations to a dict, and to its matches keyed by (low ID, high ID)
+    Each is either ["set", path, value] or ["del", path]
+    Matches are journalled with the path ["matches", low ID, high ID] and their epoch time as the value
+    """
+    for op in ops:
+        (kind, path) = (op[0], op[1])
+        if path[0] == _Key.MATCHES:
+            if kind == "set":
+                pairs[(path[1], path[2])] = op[2]
+            else:
+                pairs.pop((path[1], path[2]), None)
+            continue
+        parent = d
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        if kind == "set":
+            parent[path[-1]] = op[2]
+        else:
+            parent.pop(path[-1], None)
+
+
+class _Journal():
+    """
+    Append-only record of the writes made to a state file since its snapshot was last saved
+    Each line holds the operations from one write as JSON, so a write costs about the size of the change
+    Once the journal grows too large it's compacted into a fresh snapshot on a background thread
+    Writes can also be buffered and appended together on a background thread, see debounce
+    """
+
+    def __init__(self, file: str):
+        self._snapshot = file
+        self._file = file + ".journal"
+        # Journal being compacted into the snapshot, kept until that's safely written
+        self._compacting = file + ".journal.old"
+        self._thread: threading.Thread | None = None
+        self.entries = 0
+        self.bytes = 0
+
+        # Lines waiting to be appended when debounced, and when the first and last of them came in
+        self._pending: list[str] = []
+        self._first = 0.0
+        self._last = 0.0
+        self._delay: float | None = None
+        self._max_staleness = 0.0
+        self._pending_changed = threading.Condition()
+        # Held while appending, so lines always go out in order
+        self._append_lock = threading.Lock()
+
+        # Number of writes journalled, and number of appends to the file it took
+        self.writes = 0
+        self.appends = 0
+
+    @property
+    def coalesced(self) -> int:
+        """Number of writes that were appended along with another rather than on their own"""
+        return self.writes - self.appends
+
+    def replay(self, d: dict):
+        """Apply every journalled write to a dict loaded from the snapshot"""
+        # Matches are keyed by pair while replaying, so each journalled match is a single lookup
+        pairs = {(low, high): ts for (low, high, ts) in d.get(_Key.MATCHES, [])}
+        for file in (self._compacting, self._file):
+            if not os.path.isfile(file):
+                continue
+            with open(file) as f:
+                for line in f:
+                    try:
+                        ops = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the last line can be torn, by the bot stopping mid-write
+                        logger.warning("Skipping incomplete journal entry in %s", file)
+                        break
+                    _apply(d, pairs, ops)
+        if pairs or _Key.MATCHES in d:
+            d[_Key.MATCHES] = [[low, high, ts] for ((low, high), ts) in pairs.items()]
+
+    def clear(self):
+        """Remove the journal, once the snapshot holds everything in it"""
+        self.wait()
+        with self._append_lock, self._pending_changed:
+            self._pending = []
+            for file in (self._compacting, self._file):
+                if os.path.isfile(file):
+                    os.remove(file)
+        self.entries = 0
+        self.bytes = 0
+
+    def debounce(self, delay: float, max_staleness: float):
+        """
+        Buffer writes from now on, appending them on a background thread once none have come in for the delay
+        Nothing is left buffered for longer than max_staleness, both in seconds
+        """
+        self._delay = delay
+        self._max_staleness = max_staleness
+        threading.Thread(target=self._append_when_settled, name="state-writer", daemon=True).start()
+
+    def write(self, ops: list):
+        """Journal the operations from a write"""
+        line = json.dumps(ops) + "\n"
+        self.writes += 1
+        self.entries += 1
+        self.bytes += len(line)
+
+        if self._delay is None:
+            self._append([line])
+        else:
+            with self._pending_changed:
+                self._last = time.monotonic()
+                if not self._pending:
+                    self._first = self._last
+                self._pending.append(line)
+                self._pending_changed.notify()
+
+    def compact_if_due(self, snapshot: Callable[[], dict]):
+        """
+        Compact a snapshot of the state if the journal has grown too large
+        Everything is already journalled by now, so a failure is only logged and compacting is tried again later
+        """
+        if self.entries < _JOURNAL_MAX_ENTRIES and self.bytes < _JOURNAL_MAX_BYTES:
+            return
+        try:
+            self.compact(snapshot())
+        except OSError:
+            logger.exception("Failed to compact the state journal %s", self._file)
+
+    def flush(self):
+        """Append any buffered writes now"""
+        with self._append_lock:
+            self._append_pending()
+
+    def _append_pending(self):
+        """
+        Append the buffered writes, keeping them buffered ahead of any newer ones if that fails
+        This is never called within a transaction, so everything buffered has been committed and can be kept
+        """
+        with self._pending_changed:
+            (lines, self._pending) = (self._pending, [])
+        if not lines:
+            return
+        try:
+            self._append(lines)
+        except OSError:
+            with self._pending_changed:
+                self._pending[:0] = lines
+            raise
+
+    def _append(self, lines: list[str]):
+        with open(self._file, "a") as f:
+            f.write("".join(lines))
+        self.appends += 1
+
+    def _append_when_settled(self):
+        """Background loop appending buffered writes once they've settled"""
+        while True:
+            with self._pending_changed:
+                while not self._pending:
+                    self._pending_changed.wait()
+                while True:
+                    now = time.monotonic()
+                    due = min(self._last + self._delay, self._first + self._max_staleness)
+                    if not self._pending or now >= due:
+                        break
+                    self._pending_changed.wait(due - now)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Failed to append to the state journal %s", self._file)
+
+    def compact(self, d: dict):
+        """
+        Start writing out a fresh snapshot in the background, unless one is already being written
+        The dict is serialised on the background thread, so mustn't be changed afterwards
+        """
+        if (self._thread and self._thread.is_alive()) or os.path.isfile(self._compacting):
+            return
+
+        # Writes from now on go into a fresh journal, on top of the new snapshot
+        with self._append_lock:
+            self._append_pending()
+            os.replace(self._file, self._compacting)
+        self.entries = 0
+        self.bytes = 0
+
+        self._thread = threading.Thread(target=self._write_snapshot, args=(d,), name="state-compaction")
+        self._thread.start()
+
+    def _write_snapshot(self, d: dict):
+        """Write out a snapshot, then drop the journal it replaces"""
+        try:
+            _write(self._snapshot, _dumps(d))
+            os.remove(self._compacting)
+        except OSError:
+            logger.exception("Failed to compact the state journal into %s", self._snapshot)
+
+    def wait(self):
+        """Wait for any snapshot being written in the background"""
+        if self._thread:
+            self._thread.join()
+
+
+# Marks a key that wasn't in a dict before it was changed
+_MISSING = object()
+
+
+class _Tracker():
+    """Undo log shared by every container in a state, only recording while a transaction is open"""
+    __slots__ = ("log",)
+
+    def __init__(self):
+        # Each entry is the container, the key changed, its old value and the journal path touched
+        # Lists are small, so have their whole contents recorded with no key
+        self.log: list[tuple] | None = None
+
+
+class _TrackedDict(dict):
+    """
+    A dict within the state that records each change it makes to its tracker's undo log
+    Knows its own path in the state so changes can be journalled without diffing
+    """
+    __slots__ = ("_tracker", "_path", "_whole")
+
+    def _touch(self, key):
+        # Copies made by the schema library while validating are left untracked
+        log = self._tracker.log if hasattr(self, "_tracker") else None
+        if log is not None:
+            log.append((self, key, dict.get(self, key, _MISSING), self._path if self._whole else self._path + (key,)))
+
+    def _child(self, key, value):
+        if not hasattr(self, "_tracker"):
+            return value
+        return _track(value, self._tracker, self._path if self._whole else self._path + (key,), self._whole)
+
+    def __setitem__(self, key, value):
+        self._touch(key)
+        dict.__setitem__(self, key, self._child(key, value))
+
+    def __delitem__(self, key):
+        self._touch(key)
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._touch(key)
+        return dict.pop(self, key, *default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def popitem(self):
+        if self:
+            self._touch(next(reversed(self)))
+        return dict.popitem(self)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class _TrackedList(list):
+    """
+    A list within the state that records its whole contents to its tracker's undo log before each change
+    Anything inside a list is journalled as part of the whole list
+    """
+    __slots__ = ("_tracker", "_path")
+
+    def _touch(self):
+        log = self._tracker.log if hasattr(self, "_tracker") else None
+        if log is not None:
+            log.append((self, None, list(self), self._path))
+
+    def _child(self, value):
+        if not hasattr(self, "_tracker"):
+            return value
+        return _track(value, self._tracker, self._path, True)
+
+    def __setitem__(self, index, value):
+        self._touch()
+        if isinstance(index, slice):
+            list.__setitem__(self, index, [self._child(v) for v in value])
+        else:
+            list.__setitem__(self, index, self._child(value))
+
+    def __delitem__(self, index):
+        self._touch()
+        list.__delitem__(self, index)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def append(self, value):
+        self._touch()
+        list.append(self, self._child(value))
+
+    def extend(self, values):
+        self._touch()
+        list.extend(self, [self._child(v) for v in values])
+
+    def insert(self, index, value):
+        self._touch()
+        list.insert(self, index, self._child(value))
+
+    def remove(self, value):
+        self._touch()
+        list.remove(self, value)
+
+    def pop(self, index=-1):
+        self._touch()
+        return list.pop(self, index)
+
+    def clear(self):
+        self._touch()
+        list.clear(self)
+
+    def sort(self, *args, **kwargs):
+        self._touch()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._touch()
+        list.reverse(self)
+
+
+class _Partners():
+    """
+    Everyone a user has matched with and when they last matched, as epoch times
+    Held as arrays of ints sorted by time, oldest first, rather than a dict of objects, to keep large histories small
+    """
+    __slots__ = ("ids", "times")
+
+    def __init__(self, ids: list[int] = (), times: list[int] = ()):
+        self.ids = array("q", ids)
+        self.times = array("q", times)
+
+    def _index(self, other: int) -> int | None:
+        try:
+            return self.ids.index(other)
+        except ValueError:
+            return None
+
+    def get(self, other: int) -> int | None:
+        i = self._index(other)
+        return None if i is None else self.times[i]
+
+    def put(self, other: int, ts: int) -> bool:
+        """Set when the user last matched with a partner, returning whether they're a new partner"""
+        new = self.drop(other) is None
+        # New matches are the latest, so this is almost always an append
+        i = bisect_right(self.times, ts)
+        self.ids.insert(i, other)
+        self.times.insert(i, ts)
+        return new
+
+    def drop(self, other: int) -> int | None:
+        """Forget a partner, returning when they last matched"""
+        i = self._index(other)
+        if i is None:
+            return None
+        ts = self.times[i]
+        del self.ids[i]
+        del self.times[i]
+        return ts
+
+    def since(self, ts: int) -> array:
+        """Get the partners matched with at or after an epoch time"""
+        return self.ids[bisect_left(self.times, ts):]
+
+
+class _PairHistory():
+    """
+    Graph of every pair of users that have matched, and when they last matched, as epoch times
+    Saved as one [low ID, high ID, epoch time] record per pair, and held under both users for quick lookups
+    Changes go in the tracker's undo log with the pair's old time
+    """
+    __slots__ = ("_tracker", "_partners", "_count")
+
+    def __init__(self, tracker: _Tracker):
+        self._tracker = tracker
+        self._partners: dict[int, _Partners] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        """Iterate every (low ID, high ID, epoch time) pair"""
+        for id, partners in self._partners.items():
+            yield from ((id, other, ts) for (other, ts) in zip(partners.ids, partners.times) if id < other)
+
+    def get(self, a: int, b: int) -> int | None:
+        """Get when a pair last matched, in either order"""
+        partners = self._partners.get(a)
+        return partners.get(b) if partners else None
+
+    def partners(self, id: int) -> dict[int, int]:
+        """Get everyone a user has matched with, and when they last matched"""
+        partners = self._partners.get(id)
+        return dict(zip(partners.ids, partners.times)) if partners else {}
+
+    def history(self, id: int) -> list[tuple[int, int]]:
+        """Get when a user last matched with each partner, as (epoch time, partner ID), oldest first"""
+        partners = self._partners.get(id)
+        return list(zip(partners.times, partners.ids)) if partners else []
+
+    def partners_since(self, id: int, ts: int) -> list[int]:
+        """Get the partners a user has matched with at or after an epoch time"""
+        partners = self._partners.get(id)
+        return partners.since(ts).tolist() if partners else []
+
+    def times_within(self, ids: set[int]) -> list[int]:
+        """Get every distinct time users within a set matched with each other, oldest first"""
+        times = set()
+        for id in ids:
+            partners = self._partners.get(id)
+            if partners:
+                times.update(ts for (other, ts) in zip(partners.ids, partners.times) if other in ids)
+        return sorted(times)
+
+    def set(self, a: int, b: int, ts: int):
+        """Record when a pair last matched"""
+        (low, high) = (min(int(a), int(b)), max(int(a), int(b)))
+        self._log(low, high)
+        self._put(low, high, int(ts))
+
+    def remove(self, a: int, b: int):
+        """Forget a pair ever matched"""
+        (low, high) = (min(a, b), max(a, b))
+        if self.get(low, high) is not None:
+            self._log(low, high)
+            self._drop(low, high)
+
+    def restore(self, pair: tuple[int, int], old):
+        """Put back the time a pair had before, for rolling back"""
+        self._drop(*pair)
+        if old is not _MISSING:
+            self._put(*pair, old)
+
+    def load(self, records: list[list[int]]):
+        """Load [low ID, high ID, epoch time] records, where later records for a pair replace earlier ones"""
+        if self._partners:
+            for (low, high, ts) in records:
+                self._put(int(low), int(high), int(ts))
+            return
+
+        # Gather everything up first when empty, so each user's arrays are built in one go
+        gathered: dict[int, dict[int, int]] = {}
+        for (low, high, ts) in records:
+            (low, high, ts) = (int(low), int(high), int(ts))
+            gathered.setdefault(low, {})[high] = ts
+            gathered.setdefault(high, {})[low] = ts
+        for id, partners in gathered.items():
+            others = sorted(partners, key=partners.__getitem__)
+            self._partners[id] = _Partners(others, [partners[o] for o in others])
+            self._count += len(others)
+        self._count //= 2
+
+    def expired(self, oldest: int | None, max_partners: int | None) -> list[list[int]]:
+        """
+        Get the [low ID, high ID, epoch time] records of pairs that last matched before the oldest epoch time,
+        or that fall outside either user's most recent partners
+        """
+        expired = {}
+        for id, partners in self._partners.items():
+            end = bisect_left(partners.times, oldest) if oldest is not None else 0
+            if max_partners is not None:
+                end = max(end, len(partners.ids) - max_partners)
+            for (other, ts) in zip(partners.ids[:end], partners.times[:end]):
+                expired[(min(id, other), max(id, other))] = ts
+        return [[low, high, ts] for ((low, high), ts) in expired.items()]
+
+    def dump(self) -> list[list[int]]:
+        """Get every [low ID, high ID, epoch time] record"""
+        return [list(pair) for pair in self]
+
+    def _log(self, low: int, high: int):
+        log = self._tracker.log
+        if log is not None:
+            old = self.get(low, high)
+            log.append((self, (low, high), _MISSING if old is None else old, (_Key.MATCHES, low, high)))
+
+    def _put(self, low: int, high: int, ts: int):
+        self._count += self._partners.setdefault(low, _Partners()).put(high, ts)
+        self._partners.setdefault(high, _Partners()).put(low, ts)
+
+    def _drop(self, low: int, high: int):
+        if self.get(low, high) is None:
+            return
+        self._count -= 1
+        for (id, other) in ((low, high), (high, low)):
+            partners = self._partners[id]
+            partners.drop(other)
+            if not partners.ids:
+                del self._partners[id]
+
+
+class _Archive():
+    """
+    Append-only file of the match history moved out of a state by its retention policy
+    Each line holds the [low ID, high ID, epoch time] records archived in one go
+    Only read in when the full history is asked for, see pairs
+    """
+
+    def __init__(self, file: str | None):
+        self._file = file + ".archive" if file else None
+        # Loaded lazily, unless there's no file to load from
+        self._pairs: _PairHistory | None = None if file else _PairHistory(_Tracker())
+
+    def append(self, records: list[list[int]]):
+        """Add records to the archive"""
+        if self._file:
+            with open(self._file, "a") as f:
+                f.write(json.dumps(records) + "\n")
+        if self._pairs is not None:
+            self._pairs.load(records)
+
+    def pairs(self) -> _PairHistory:
+        """Get every archived pair, reading the archive in the first time"""
+        if self._pairs is None:
+            self._pairs = _PairHistory(_Tracker())
+            if os.path.isfile(self._file):
+                with open(self._file) as f:
+                    for line in f:
+                        try:
+                            records = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Only the last line can be torn, by the bot stopping mid-write
+                            logger.warning("Skipping incomplete archive entry in %s", self._file)
+                            break
+                        self._pairs.load(records)
+        return self._pairs
+
+
+def _track(value, tracker: _Tracker, path: tuple, whole: bool):
+    """
+    Copy a value into tracked containers for a state
+    Changes inside a whole container are journalled as the path of that container
+    """
+    if isinstance(value, dict):
+        tracked = _TrackedDict()
+        (tracked._tracker, tracked._path, tracked._whole) = (tracker, path, whole)
+        for key, item in value.items():
+            dict.__setitem__(tracked, key, _track(item, tracker, path if whole else path + (key,), whole))
+        return tracked
+    if isinstance(value, list):
+        tracked = _TrackedList()
+        (tracked._tracker, tracked._path) = (tracker, path)
+        list.extend(tracked, (_track(item, tracker, path, True) for item in value))
+        return tracked
+    return value
+
+
+def _rollback(log: list[tuple]):
+    """Undo every change in an undo log, latest first"""
+    for (container, key, old, _) in reversed(log):
+        if isinstance(container, _PairHistory):
+            container.restore(key, old)
+        elif key is None:
+            list.__setitem__(container, slice(None), old)
+        elif old is _MISSING:
+            dict.pop(container, key, None)
+        else:
+            dict.__setitem__(container, key, old)
+
+
 class _State():
     def __init__(self, data: dict, file: str | None = None):
         """Copy the data, migrate if needed, and validate"""
-        self._dict = copy.deepcopy(data)
+        # Matches are held as records rather than tracked containers, see _PairHistory
+        data = dict(data)
+        matches = data.pop(_Key.MATCHES, [])
+
+        self._tracker = _Tracker()
+        self._dict = _track(data, self._tracker, (), False)
         self._file = file
+        self._journal = _Journal(file) if file else None
 
         version = self._dict.get("version", 0)
         for i in range(version, _VERSION):
             logger.info("Migrating from v%s to v%s", version, version+1)
             _MIGRATIONS[i](self._dict)
             self._dict[_Key.VERSION] = _VERSION
+        matches = dict.pop(self._dict, _Key.MATCHES, matches)
 
-        _SCHEMA.validate(self._dict)
+        self.validate()
+        _VALIDATOR.child(_Key.MATCHES).validate(matches, (_Key.MATCHES,))
+        self._matches = _PairHistory(self._tracker)
+        self._matches.load(matches)
+        self._archive = _Archive(file)
+        self._retention: tuple[timedelta | None, int | None] = (None, None)
+        self._build_index()
+
+    def validate(self):
+        """Fully validate the state against the schema, other than the matches which are only ever set as ints"""
+        _VALIDATOR.validate(self._dict)
+
+    def dump(self) -> dict:
+        """
+        Get a copy of the whole state as a dict, in the format it's saved in
+        Only the containers are copied, so it's cheap enough to take before serialising it elsewhere
+        """
+        return {**_copy_containers(self._dict), _Key.MATCHES: self._matches.dump()}
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group any number of writes into one, for use as a context manager
+        Every change made within is recorded, then the state is validated and the changes journalled once
+        Rolls every change back if anything fails, and joins any transaction already open
+        """
+        if self._tracker.log is not None:
+            yield
+            return
+
+        log = self._tracker.log = []
+        try:
+            yield
+            paths = self._touched(log)
+            for path in (p for p in paths if p[0] != _Key.MATCHES):
+                validation.validate_path(_VALIDATOR, self._dict, path)
+            if self._journal and paths:
+                self._journal.write(self._changes(paths))
+        except BaseException:
+            _rollback(log)
+            raise
+        finally:
+            self._tracker.log = None
+            self._reindex(self._touched(log))
+
+        # Compacting can only happen once the write's journalled, so it mustn't fail the write
+        if self._journal:
+            self._journal.compact_if_due(self.dump)
+
+    def _build_index(self):
+        """Build up the index of which users are active and paused in each channel"""
+        # Channel ID to the IDs of the users active in it
+        self._active: dict[str, set[str]] = {}
+        # Channel ID to the IDs of the users paused in it, with their reactivation times
+        self._paused: dict[str, dict[str, int]] = {}
+        # User ID to the channels they're indexed under
+        self._indexed: dict[str, set[str]] = {}
+        # Channel ID to a min-heap of (reactivate time, user ID) entries
+        self._reactivations: dict[str, list[tuple[int, str]]] = {}
+        # Every (channel ID, user ID, reactivate time) currently in a heap
+        self._scheduled: set[tuple[str, str, int]] = set()
+        for id in self._users:
+            self._index_user(id)
+
+    def _index_user(self, id: str):
+        """Bring the channel index up to date for a single user"""
+        for channel in self._indexed.pop(id, ()):
+            self._active[channel].discard(id)
+            self._paused[channel].pop(id, None)
+
+        channels = self._users.get(id, {}).get(_Key.CHANNELS, {})
+        if channels:
+            self._indexed[id] = set(channels)
+        for channel, data in channels.items():
+            active = self._active.setdefault(channel, set())
+            paused = self._paused.setdefault(channel, {})
+            if data.get(_Key.ACTIVE):
+                active.add(id)
+            if data.get(_Key.REACTIVATE):
+                paused[id] = data[_Key.REACTIVATE]
+                self._schedule_reactivation(channel, id, data[_Key.REACTIVATE])
+
+    def _schedule_reactivation(self, channel: str, id: str, ts: int):
+        """Add a reactivation to its channel's heap, unless it's already there"""
+        entry = (channel, id, ts)
+        if entry not in self._scheduled:
+            self._scheduled.add(entry)
+            heapq.heappush(self._reactivations.setdefault(channel, []), (ts, id))
+
+    def _reindex(self, paths: list[tuple]):
+        """Bring the channel index up to date for the users under any touched paths"""
+        for path in paths:
+            if len(path) < 2 and path[:1] in ((), (_Key.USERS,)):
+                self._build_index()
+                return
+        for path in paths:
+            if path[0] == _Key.USERS:
+                self._index_user(path[1])
+
+    @staticmethod
+    def _touched(log: list[tuple]) -> list[tuple]:
+        """Get the paths touched in an undo log, leaving out any under another touched path"""
+        paths = dict.fromkeys(path for (_, _, _, path) in log)
+        return [path for path in paths if not any(path[:i] in paths for i in range(1, len(path)))]
+
+    def _changes(self, paths: list[tuple]) -> list:
+        """Get the journal operations that set or delete each touched path"""
+        ops = []
+        for path in paths:
+            if path[0] == _Key.MATCHES:
+                ts = self._matches.get(path[1], path[2])
+                ops.append(["del", list(path)] if ts is None else ["set", list(path), ts])
+                continue
+            value = self._dict
+            for key in path:
+                value = value.get(key, _MISSING) if isinstance(value, dict) else _MISSING
+            ops.append(["del", list(path)] if value is _MISSING else ["set", list(path), value])
+        return ops
 
     @staticmethod
     def safe_write(func):
         """
-        Wraps any function running it first on some temporary state
-        Validates the resulting state and only then attempts to save it out
-        before storing the dict back in the State
+        Wraps any function running it in a transaction
+        Changes are recorded as they're made, then the state is validated and the changes journalled
+        Should anything fail every change is rolled back
         """
         @wraps(func)
         def inner(self, *args, **kwargs):
-            tmp = _State(self._dict, self._file)
-            func(tmp, *args, **kwargs)
-            _SCHEMA.validate(tmp._dict)
-            if tmp._file:
-                _save(tmp._file, tmp._dict)
-            self._dict = tmp._dict
+            with self.transaction():
+                return func(self, *args, **kwargs)
 
         return inner
 
     def get_history_timestamps(self, users: list[Member]) -> list[datetime]:
         """Grab all timestamps in the history"""
-        others = [m.id for m in users]
+        return [epoch_to_datetime(ts) for ts in self.get_history_times(m.id for m in users)]
 
-        # Fetch all the interaction times in history
-        # But only for interactions in the given user group
-        times = set()
-        for data in (data for id, data in self._users.items() if int(id) in others):
-            matches = data.get(_Key.MATCHES, {})
-            for ts in (ts for id, ts in matches.items() if int(id) in others):
-                times.add(ts)
+    def get_history_times(self, ids: list[int]) -> list[int]:
+        """Get every distinct epoch time the given users matched with each other, oldest first"""
+        return self._matches.times_within(set(int(id) for id in ids))
+
+    def get_user_matches(self, id: int) -> dict[int, int]:
+        """Get each user a user has matched with, and the epoch time they last matched"""
+        return self._matches.partners(int(id))
+
+    def get_user_match_history(self, id: int) -> list[tuple[int, int]]:
+        """Get the epoch time a user last matched with each partner, as (time, partner ID), oldest first"""
+        return self._matches.history(int(id))
 
-        # Convert to datetimes and sort
-        datetimes = [ts_to_datetime(ts) for ts in times]
-        datetimes.sort()
-        return datetimes
+    def get_user_partners_since(self, id: int, ts: int) -> list[int]:
+        """Get the IDs of everyone a user has matched with at or after an epoch time"""
+        return self._matches.partners_since(int(id), ts)
 
-    def get_user_matches(self, id: int) -> list[int]:
-        return self._users.get(str(id), {}).get(_Key.MATCHES, {})
+    def get_pair_matched(self, a: int, b: int) -> int | None:
+        """Get the epoch time a pair of users last matched, if they ever have"""
+        return self._matches.get(int(a), int(b))
+
+    def get_user_full_matches(self, id: int) -> dict[int, int]:
+        """
+        Get each user a user has ever matched with, and the epoch time they last matched
+        Includes any archived history, so reads in the archive the first time it's called
+        """
+        return self._archive.pairs().partners(int(id)) | self._matches.partners(int(id))
+
+    def set_retention(self, max_age: timedelta | None = None, max_partners: int | None = None):
+        """
+        Set how much match history to keep in the state, archiving anything older right away
+        Pairs are kept while they last matched within the max age, and are among both users' max partners most recent
+        """
+        self._retention = (max_age, max_partners)
+        self.archive_history()
+
+    def archive_history(self, now: datetime | None = None) -> int:
+        """Move any match history outside the retention policy into the archive, returning how many pairs moved"""
+        (max_age, max_partners) = self._retention
+        if max_age is None and max_partners is None:
+            return 0
+
+        oldest = datetime_to_epoch((now or datetime.now()) - max_age) if max_age is not None else None
+        records = self._matches.expired(oldest, max_partners)
+        if not records:
+            return 0
+
+        # Archived first, so nothing's lost should the bot stop in between
+        self._archive.append(records)
+        with self.transaction():
+            for (low, high, _) in records:
+                self._matches.remove(low, high)
+        logger.info("Archived %s pair(s) of match history", len(records))
+        return len(records)
 
     @safe_write
     def log_groups(self, groups: list[list[Member]], ts: datetime = None) -> None:
         """Log the groups"""
-        ts = datetime_to_ts(ts or datetime.now())
+        ts = datetime_to_epoch(ts or datetime.now())
         for group in groups:
-            # Update the matchee data with the matches
-            for m in group:
-                matchee = self._users.setdefault(str(m.id), {})
-                matchee_matches = matchee.setdefault(_Key.MATCHES, {})
-
-                for o in (o for o in group if o.id != m.id):
-                    matchee_matches[str(o.id)] = ts
+            for (m, o) in itertools.combinations(group, 2):
+                if m.id != o.id:
+                    self._matches.set(m.id, o.id, ts)
 
     @safe_write
     def set_user_scope(self, id: str, scope: str, value: bool = True):
@@ -287,30 +1101,58 @@ class _State():
         util.set_nested_value(
             self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.REACTIVATE, value=None)
 
+    @safe_write
+    def set_users_active_in_channel(self, ids: list[str], channel_id: str, active: bool = True):
+        """Set a set of users as active (or not) on a given channel"""
+        for id in ids:
+            self.set_user_active_in_channel(id, channel_id, active)
+
     def get_user_active_in_channel(self, id: str, channel_id: str) -> bool:
         """Get a if a user is active in a channel"""
         return util.get_nested_value(self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.ACTIVE)
 
-    def get_user_paused_in_channel(self, id: str, channel_id: str) -> str:
-        """Get a the user reactivate time if it exists"""
+    def get_user_paused_in_channel(self, id: str, channel_id: str) -> int:
+        """Get a the user reactivate epoch time if it exists"""
         return util.get_nested_value(self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.REACTIVATE)
 
+    def get_active_users_in_channel(self, channel_id: str) -> set[str]:
+        """Get the IDs of every user active in a channel"""
+        return set(self._active.get(str(channel_id), ()))
+
+    def get_paused_users_in_channel(self, channel_id: str) -> dict[str, int]:
+        """Get the IDs of every user paused in a channel, with their reactivate times"""
+        return dict(self._paused.get(str(channel_id), {}))
+
     @safe_write
     def set_user_paused_in_channel(self, id: str, channel_id: str, until: datetime):
         """Sets a user as inactive in a channel with a reactivation time"""
         util.set_nested_value(
             self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.ACTIVE, value=False)
         util.set_nested_value(
-            self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.REACTIVATE, value=datetime_to_ts(until))
+            self._users, str(id), _Key.CHANNELS, str(channel_id), _Key.REACTIVATE, value=datetime_to_epoch(until))
 
-    @safe_write
     def reactivate_users(self, channel_id: str):
-        """Reactivate any users who've passed their reactivation time on this channel"""
-        for user in self._users:
-            reactivate = self.get_user_paused_in_channel(
-                str(user), str(channel_id))
-            if reactivate and datetime.now() > ts_to_datetime(reactivate):
-                self.set_user_active_in_channel(str(user), str(channel_id))
+        """
+        Reactivate any users who've passed their reactivation time on this channel
+        Only the users that are due are looked at, and they're all reactivated in one write
+        """
+        channel = str(channel_id)
+        heap = self._reactivations.get(channel, [])
+        now = datetime_to_epoch(datetime.now())
+
+        due = []
+        while heap and heap[0][0] < now:
+            (ts, id) = heapq.heappop(heap)
+            self._scheduled.discard((channel, id, ts))
+            # Skip anyone who's since been unpaused or paused again, they'll have been rescheduled
+            if self.get_user_paused_in_channel(id, channel) == ts:
+                due.append(id)
+
+        # Any users that fail to reactivate are put back in the heap when they're reindexed
+        if due:
+            with self.transaction():
+                for id in due:
+                    self.set_user_active_in_channel(id, channel)
 
     def get_active_match_tasks(self, time: datetime | None = None) -> Generator[str, int]:
         """
@@ -374,6 +1216,26 @@ class _State():
     def _users(self) -> dict[str]:
         return self._dict[_Key.USERS]
 
+    def persist_in_background(self, delay: float, max_staleness: float):
+        """
+        Journal writes on a background thread from now on, once they've settled for the delay
+        Writes in quick succession are appended together, and none wait longer than max_staleness
+        Anything still buffered is flushed on exit
+        """
+        if not self._journal:
+            return
+        self._journal.debounce(delay, max_staleness)
+        atexit.register(self.flush)
+
+    def flush(self):
+        """Write out anything buffered, and wait for any compaction to finish"""
+        if not self._journal:
+            return
+        self._journal.flush()
+        self._journal.wait()
+        logger.info("Flushed state, %s write(s) journalled in %s append(s)",
+                    self._journal.writes, self._journal.appends)
+
     @property
     def _tasks(self) -> dict[str]:
         return self._dict[_Key.TASKS]
@@ -382,12 +1244,26 @@ class _State():
 def load_from_file(file: str) -> _State:
     """
     Load the state from a files
+    Any journalled writes are replayed on top, then saved into a fresh snapshot
     """
-    loaded = _load(file) if os.path.isfile(file) else _EMPTY_DICT
+    loaded = _load(file) if os.path.isfile(file) else copy.deepcopy(_EMPTY_DICT)
+    journal = _Journal(file)
+    journal.replay(loaded)
     st = _State(loaded, file)
-    _save(file, st._dict)
+    _save(file, st.dump())
+    st._journal.clear()
     return st
 
 
+def _load_backend():
+    """Load the state with the backend chosen by the STATE_BACKEND envar, either json or sqlite"""
+    if os.environ.get("STATE_BACKEND", "json") == "sqlite":
+        # Imported here as it's built on this module
+        import matchy.sqlite_state as sqlite_state
+        return sqlite_state.load_from_db(_STATE_DB, import_from=_STATE_FILE)
+    return load_from_file(_STATE_FILE)
+
+
 _STATE_FILE = ".matchy/state.json"
-State = load_from_file(_STATE_FILE)
+_STATE_DB = ".matchy/state.db"
+State = _load_backend()
@@ -0,0 +1,185 @@
+"""
+Fast validators compiled from schemas
+Covers the parts of the schema library the state schema uses, accepting and rejecting the same data
+Compiled validators can also check a single entry within the data, rather than all of it
+"""
+from abc import ABC, abstractmethod
+from schema import Schema, Use, Optional, SchemaError, SchemaMissingKeyError, SchemaWrongKeyError
+
+
+def _describe(path: tuple) -> str:
+    """Describe a path within the data for an error"""
+    return "/".join(str(key) for key in path) or "root"
+
+
+class _Validator(ABC):
+    """Validates a value against part of a schema"""
+
+    @abstractmethod
+    def validate(self, data, path: tuple = ()):
+        """Validate a value, and everything within it"""
+
+    def child(self, key) -> "_Validator | None":
+        """Get the validator for an entry within a value, if there is one"""
+        return None
+
+
+class _UseValidator(_Validator):
+    """Validates a value can be converted with a callable, as Use does"""
+
+    def __init__(self, func):
+        self._func = func
+
+    def validate(self, data, path: tuple = ()):
+        try:
+            self._func(data)
+        except Exception as e:
+            raise SchemaError(f"{_describe(path)}: {self._func!r}({data!r}) raised {e!r}")
+
+
+class _TypeValidator(_Validator):
+    """Validates a value is an instance of a type, as a bare type does"""
+
+    def __init__(self, type_: type):
+        self._type = type_
+
+    def validate(self, data, path: tuple = ()):
+        # The schema library never counts a bool as an int
+        if not isinstance(data, self._type) or (self._type is int and isinstance(data, bool)):
+            raise SchemaError(f"{_describe(path)}: {data!r} should be instance of {self._type.__name__!r}")
+
+
+class _LiteralValidator(_Validator):
+    """Validates a value equals a literal"""
+
+    def __init__(self, value):
+        self._value = value
+
+    def validate(self, data, path: tuple = ()):
+        if data != self._value:
+            raise SchemaError(f"{_describe(path)}: {self._value!r} does not match {data!r}")
+
+
+class _ListValidator(_Validator):
+    """Validates a list, where each item must match one of the item schemas"""
+
+    def __init__(self, items: list[_Validator]):
+        self._items = items
+
+    def validate(self, data, path: tuple = ()):
+        if not isinstance(data, list):
+            raise SchemaError(f"{_describe(path)}: {data!r} should be instance of 'list'")
+        for index, item in enumerate(data):
+            for validator in self._items:
+                try:
+                    validator.validate(item, path + (index,))
+                    break
+                except SchemaError:
+                    pass
+            else:
+                raise SchemaError(f"{_describe(path + (index,))}: {item!r} did not match any item schema")
+
+
+class _DictValidator(_Validator):
+    """
+    Validates a dict, where each key must match one of the key schemas and its value the matching value schema
+    Literal keys are matched before type keys, the same as the schema library
+    """
+
+    def __init__(self, literals: dict, types: list[tuple[type, _Validator]], required: set):
+        self._literals = literals
+        self._types = types
+        self._required = required
+
+    def validate(self, data, path: tuple = ()):
+        self._validate_type(data, path)
+        for key, value in data.items():
+            self._validate_entry(key, value, path)
+        self._validate_required(data, path)
+
+    def validate_key(self, data, key, path: tuple = ()):
+        """Validate a single entry in a dict, which may have been removed, and that nothing required is missing"""
+        self._validate_type(data, path)
+        if key in data:
+            self._validate_entry(key, data[key], path)
+        self._validate_required(data, path)
+
+    def child(self, key) -> _Validator | None:
+        if key in self._literals:
+            return self._literals[key]
+        for (type_, validator) in self._types:
+            if isinstance(key, type_) and not (type_ is int and isinstance(key, bool)):
+                return validator
+        return None
+
+    def _validate_type(self, data, path: tuple):
+        if not isinstance(data, dict):
+            raise SchemaError(f"{_describe(path)}: {data!r} should be instance of 'dict'")
+
+    def _validate_entry(self, key, value, path: tuple):
+        validator = self.child(key)
+        if validator is None:
+            raise SchemaWrongKeyError(f"{_describe(path)}: Wrong key {key!r}")
+        validator.validate(value, path + (key,))
+
+    def _validate_required(self, data, path: tuple):
+        missing = [key for key in self._required if key not in data]
+        if missing:
+            raise SchemaMissingKeyError(f"{_describe(path)}: Missing keys {', '.join(repr(k) for k in missing)}")
+
+
+def compile_schema(schema) -> _Validator:
+    """Compile a schema, or part of one, into a validator"""
+    if isinstance(schema, Schema) and not isinstance(schema, Optional):
+        return compile_schema(schema.schema)
+
+    if isinstance(schema, Use):
+        return _UseValidator(schema._callable)
+
+    if isinstance(schema, type):
+        return _TypeValidator(schema)
+
+    if isinstance(schema, list):
+        return _ListValidator([compile_schema(item) for item in schema])
+
+    if isinstance(schema, dict):
+        (literals, types, required) = ({}, [], set())
+        for key, value in schema.items():
+            optional = isinstance(key, Optional)
+            key_schema = key.schema if optional else key
+            if isinstance(key_schema, type):
+                if not optional:
+                    raise ValueError(f"Required type keys aren't supported: {key!r}")
+                types.append((key_schema, compile_schema(value)))
+            elif isinstance(key_schema, (str, int)):
+                literals[key_schema] = compile_schema(value)
+                if not optional:
+                    required.add(key_schema)
+            else:
+                raise TypeError(f"Unsupported schema key {key!r}")
+        return _DictValidator(literals, types, required)
+
+    if isinstance(schema, (str, int, float, bool)) or schema is None:
+        return _LiteralValidator(schema)
+
+    raise TypeError(f"Unsupported schema {schema!r}")
+
+
+def validate_path(validator: _Validator, data, path: tuple):
+    """
+    Validate only the entry at a path within some data, which may have been removed
+    Everything above the path is assumed to be valid already
+    """
+    (parent, parent_validator) = (data, validator)
+    for (depth, key) in enumerate(path[:-1]):
+        parent_validator = parent_validator.child(key)
+        parent = parent[key]
+        if not isinstance(parent_validator, _DictValidator):
+            # Paths only run through dicts, so anything else is validated whole
+            parent_validator.validate(parent, path[:depth + 1])
+            return
+
+    if not isinstance(parent_validator, _DictValidator):
+        parent_validator.validate(parent, path[:-1])
+        return
+    parent_validator.validate_key(parent, path[-1], path[:-1])
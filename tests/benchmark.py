@@ -0,0 +1,195 @@
+"""
+    Benchmarks for the matching engine on synthetic guilds
+    Run from the repository root with `python -m tests.benchmark`, which compares the results
+    against any stored baseline, and pass `--save` to store the results as the new baseline
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import matchy.matching as matching
+import matchy.state as state
+
+_BASELINE_FILE = os.path.join(os.path.dirname(__file__), "benchmark-baseline.json")
+
+# Scenario axes, every combination is run
+_SCENARIOS = {
+    "quick": {
+        "members": (10, 100, 1000),
+        "roles": (1, 4),
+        "weeks": (0, 8),
+        "per_group": (2, 3, 5),
+    },
+    "full": {
+        "members": (10, 100, 1000, 10000),
+        "roles": (1, 4, 8),
+        "weeks": (0, 8, 26),
+        "per_group": (2, 3, 5),
+    },
+}
+
+# Number of roles in each synthetic guild
+_GUILD_ROLES = 20
+
+# Default time budget for each match, the same as a scheduled channel match
+_TIMEOUT = 60.0
+
+# Results that can regress, and the smallest change worth flagging for each
+_METRICS = {
+    "seconds": 0.05,
+    "attempts": 1,
+    "scores": 100,
+    "peak_memory": 1024 * 1024,
+}
+
+
+class Role():
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: int):
+        self.id = id
+        self.name = f"role{id}"
+
+
+class Member():
+    __slots__ = ("id", "mention", "display_name", "roles")
+
+    def __init__(self, id: int, roles: list[Role]):
+        self.id = id
+        self.mention = f"<@{id}>"
+        self.display_name = f"{id}"
+        self.roles = roles
+
+
+def scenario_name(members: int, roles: int, weeks: int, per_group: int) -> str:
+    return f"members={members} roles={roles} weeks={weeks} per_group={per_group}"
+
+
+def build_guild(members: int, roles: int, weeks: int, per_group: int) -> list[Member]:
+    """Create a guild of members and write weeks of match history for them into a fresh state"""
+    # Seed from the scenario so each one is stable between runs
+    rand = random.Random(members * 3 + roles * 5 + weeks * 7 + per_group * 11)
+    guild_roles = [Role(i) for i in range(1, _GUILD_ROLES + 1)]
+    guild = [Member(i, rand.sample(guild_roles, roles)) for i in range(1, members + 1)]
+
+    state.State = state._State(state._EMPTY_DICT)
+    num_groups = max(members // per_group, 1)
+    for week in range(weeks):
+        rand.shuffle(guild)
+        groups = [guild[i::num_groups] for i in range(num_groups)]
+        state.State.log_groups(groups, datetime.now() - timedelta(weeks=weeks - week))
+
+    rand.shuffle(guild)
+    return guild
+
+
+def match(guild: list[Member], per_group: int, timeout: float, processes: int) -> matching.MatchStats:
+    """Match the guild the same way a channel match would"""
+    stats = matching.MatchStats()
+    matching.members_to_groups(guild, per_group,
+                               allow_fallback=True,
+                               local_search=matching._LOCAL_SEARCH_ITERATIONS,
+                               local_search_seconds=matching._LOCAL_SEARCH_SECONDS,
+                               timeout=timeout,
+                               stats=stats,
+                               processes=processes)
+    return stats
+
+
+def run_scenario(members: int, roles: int, weeks: int, per_group: int, timeout: float, processes: int) -> dict:
+    """Run a single scenario, returning its results"""
+    guild = build_guild(members, roles, weeks, per_group)
+
+    # Time the match on its own, as tracing memory slows everything down
+    start = time.perf_counter()
+    stats = match(guild, per_group, timeout, processes)
+    seconds = time.perf_counter() - start
+
+    # Then run it again to measure memory use
+    tracemalloc.start()
+    match(guild, per_group, timeout, processes)
+    (_, peak_memory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": round(seconds, 4),
+        "attempts": stats.attempts,
+        "scores": stats.scores,
+        "peak_memory": peak_memory,
+        "timed_out": stats.timed_out,
+        "fell_back": stats.fell_back,
+    }
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Compare results against a baseline, describing anything that got noticeably worse"""
+    regressions = []
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for (metric, minimum) in _METRICS.items():
+            (old, new) = (base[metric], result[metric])
+            if new > old * (1 + tolerance) and new - old >= minimum:
+                regressions.append(f"{name}: {metric} {old} -> {new}")
+        if result["timed_out"] and not base["timed_out"]:
+            regressions.append(f"{name}: timed out")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", choices=_SCENARIOS.keys(), default="quick",
+                        help="Which set of scenarios to run")
+    parser.add_argument("--filter", default="",
+                        help="Only run scenarios with this in their name")
+    parser.add_argument("--timeout", type=float, default=_TIMEOUT,
+                        help="Time budget for each match in seconds")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Number of processes to match with in parallel")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction a result can get worse by before it's flagged")
+    parser.add_argument("--baseline", default=_BASELINE_FILE,
+                        help="Baseline file to compare against or save to")
+    parser.add_argument("--save", action="store_true",
+                        help="Save the results as the new baseline")
+    args = parser.parse_args()
+
+    axes = _SCENARIOS[args.scenarios]
+    results = {}
+    for (members, roles, weeks, per_group) in itertools.product(
+            axes["members"], axes["roles"], axes["weeks"], axes["per_group"]):
+        name = scenario_name(members, roles, weeks, per_group)
+        if args.filter not in name:
+            continue
+        results[name] = run_scenario(members, roles, weeks, per_group, args.timeout, args.processes)
+        print(f"{name}: {results[name]}", flush=True)
+
+    exitcode = 0
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regression(s) against {args.baseline}")
+        exitcode = 1 if regressions else 0
+
+    if args.save:
+        # Keep the baseline for any scenarios that weren't run this time
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+
+    return exitcode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+    Test functions for the blossom module
+"""
+import pytest
+import random
+from matchy.blossom import max_weight_matching
+
+
+def brute_force_matching(edges, max_cardinality):
+    """Find the best (cardinality, weight) of any matching by trying them all"""
+    weights = {}
+    for (i, j, w) in edges:
+        weights[(i, j)] = weights[(j, i)] = w
+
+    def best(remaining):
+        if not remaining:
+            return (0, 0)
+        (v, rest) = (remaining[0], remaining[1:])
+        options = [best(rest)]
+        for u in (u for u in rest if (v, u) in weights):
+            (card, weight) = best([x for x in rest if x != u])
+            options.append((card + 1, weight + weights[(v, u)]))
+        if max_cardinality:
+            return max(options)
+        return max(options, key=lambda o: o[1])
+
+    num_vertices = 1 + max(max(i, j) for (i, j, _) in edges)
+    return best(list(range(num_vertices)))
+
+
+def test_empty():
+    assert max_weight_matching([]) == []
+
+
+def test_simple():
+    # A path of three edges where the middle one is heaviest
+    edges = [(0, 1, 5), (1, 2, 11), (2, 3, 5)]
+    assert max_weight_matching(edges) == [-1, 2, 1, -1]
+    assert max_weight_matching(edges, max_cardinality=True) == [1, 0, 3, 2]
+
+
+def test_blossom():
+    # An odd cycle that has to be shrunk into a blossom to find the augmenting path
+    edges = [(0, 1, 8), (0, 2, 9), (1, 2, 10), (2, 3, 7)]
+    assert max_weight_matching(edges) == [1, 0, 3, 2]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_against_brute_force(seed):
+    """Compare random graphs against trying every matching"""
+    rand = random.Random(seed)
+    for _ in range(25):
+        num_vertices = rand.randint(2, 8)
+        edges = [(i, j, rand.randint(-5, 20))
+                 for i in range(num_vertices) for j in range(i + 1, num_vertices)
+                 if rand.random() < 0.6]
+        if not edges:
+            continue
+        max_cardinality = rand.random() < 0.5
+
+        mate = max_weight_matching(edges, max_cardinality)
+
+        # The mates must agree with each other and only use real edges
+        weights = {(min(i, j), max(i, j)): w for (i, j, w) in edges}
+        for (v, u) in enumerate(mate):
+            if u >= 0:
+                assert mate[u] == v
+                assert (min(u, v), max(u, v)) in weights
+
+        card = sum(1 for (v, u) in enumerate(mate) if u > v)
+        weight = sum(weights[(v, u)] for (v, u) in enumerate(mate) if u > v)
+        (best_card, best_weight) = brute_force_matching(edges, max_cardinality)
+        assert weight == best_weight
+        if max_cardinality:
+            assert card == best_card
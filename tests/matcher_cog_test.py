@@ -0,0 +1,230 @@
+import aiohttp
+import asyncio
+import concurrent.futures
+import random
+import time
+import types
+from datetime import datetime, timedelta
+import discord
+import pytest
+import matchy.cogs.matcher as matcher
+import matchy.state as state
+from tests.matching_test import Member, make_members_with_history
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    """Ensure every test has a clean state, and doesn't wait around between retries"""
+    state.State = state._State(state._EMPTY_DICT)
+    monkeypatch.setattr(matcher, "_POST_RETRY_DELAY", 0)
+
+
+def server_error() -> discord.DiscordServerError:
+    return discord.DiscordServerError(types.SimpleNamespace(status=503, reason="Unavailable"), "")
+
+
+class Channel():
+    """Fake channel that records posts, dropping the first few thread connections and failing threads on one message"""
+
+    def __init__(self, id: int, members: list[Member], dropped_threads: int = 0, failed_thread: int | None = None,
+                 disconnected_thread: int | None = None):
+        self.id = id
+        self.members = members
+        self.guild = types.SimpleNamespace(me=None)
+        self.sent = []
+        self.threads = []
+        self.active_threads = 0
+        self.most_active_threads = 0
+        self._dropped_threads = dropped_threads
+        self._failed_thread = failed_thread
+        self._disconnected_thread = disconnected_thread
+
+    def permissions_for(self, _):
+        return types.SimpleNamespace(create_public_threads=True)
+
+    async def send(self, content: str):
+        self.sent.append(content)
+        return content
+
+    async def create_thread(self, name: str, message: str, reason: str):
+        if self._dropped_threads:
+            self._dropped_threads -= 1
+            raise ConnectionResetError()
+        self.active_threads += 1
+        self.most_active_threads = max(self.most_active_threads, self.active_threads)
+        await asyncio.sleep(0.01)
+        self.active_threads -= 1
+        if self._failed_thread is not None and message == self.sent[self._failed_thread]:
+            raise server_error()
+        if self._disconnected_thread is not None and message == self.sent[self._disconnected_thread]:
+            raise aiohttp.ServerDisconnectedError()
+        self.threads.append(message)
+
+
+def make_channel(num_members: int, **kwargs) -> Channel:
+    members = make_members_with_history(random.Random(num_members), num_members)
+    channel = Channel(1, members, **kwargs)
+    for member in members:
+        state.State.set_user_active_in_channel(member.id, channel.id)
+    return channel
+
+
+@pytest.mark.asyncio
+async def test_match_groups_in_channel_posts_in_order():
+    """Validate group messages go out in order, with a thread for each, under the concurrency cap"""
+    channel = make_channel(60)
+    stats = await matcher.match_groups_in_channel(channel, 3)
+
+    # Every group message is sent before the closing message, and threads are made from those messages
+    groups = channel.sent[:-1]
+    assert len(groups) == 20
+    assert sorted(channel.threads, key=groups.index) == groups
+    assert 1 < channel.most_active_threads <= matcher._POST_CONCURRENCY
+    assert stats.messages == 21
+    assert stats.threads == 20
+    assert (stats.retries, stats.failed_threads) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_match_groups_in_channel_retries():
+    """Validate dropped thread connections are retried, and threads that can't be made don't stop the posting"""
+    channel = make_channel(30, dropped_threads=matcher._POST_ATTEMPTS - 1, failed_thread=3)
+    stats = await matcher.match_groups_in_channel(channel, 3)
+
+    assert stats.messages == 11
+    assert len(channel.sent) == 11
+    assert stats.threads == 9
+    assert stats.failed_threads == 1
+    assert channel.sent[3] not in channel.threads
+    # Server errors are left to discord.py to retry
+    assert stats.retries == matcher._POST_ATTEMPTS - 1
+
+
+@pytest.mark.asyncio
+async def test_match_groups_in_channel_disconnected():
+    """Validate threads failing on a dropped server connection are retried, then counted without stopping the match"""
+    channel = make_channel(30, disconnected_thread=1)
+    stats = await matcher.match_groups_in_channel(channel, 3)
+
+    assert stats.messages == 11
+    assert stats.threads == 9
+    assert stats.failed_threads == 1
+    assert stats.retries == matcher._POST_ATTEMPTS - 1
+    # The groups are still logged
+    assert all(state.State.get_user_matches(member.id) for member in channel.members)
+
+
+@pytest.mark.asyncio
+async def test_queued_matches_dont_time_out(monkeypatch):
+    """Validate matches queued behind others for a thread only start their timeout once they're running"""
+    def slow_match(snapshot, min, timeout, stats):
+        time.sleep(timeout * 0.8)
+        return [snapshot]
+
+    monkeypatch.setattr(matcher.matching, "snapshot_active_members", lambda channel: channel)
+    monkeypatch.setattr(matcher.matching, "snapshot_to_groups", slow_match)
+    monkeypatch.setattr(matcher, "_MATCH_TIMEOUT_GRACE", 0.05)
+    monkeypatch.setattr(matcher, "_match_executor", concurrent.futures.ThreadPoolExecutor(max_workers=2))
+    groups = await asyncio.gather(*[matcher.active_members_to_groups(id, 3, 0.1) for id in range(5)])
+    assert groups == [[id] for id in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_match_button_timed_out(monkeypatch):
+    """Validate the match button lets the user know when matching timed out"""
+    class Responder():
+        async def send_message(self, content: str, **kwargs):
+            self.content = content
+
+        async def send(self, content: str, **kwargs):
+            self.content = content
+
+    async def timed_out(channel: Channel, min: int):
+        raise TimeoutError()
+
+    monkeypatch.setattr(matcher, "match_groups_in_channel", timed_out)
+    monkeypatch.setattr(matcher.strings, "match_timed_out", lambda: "Timed out")
+    interaction = types.SimpleNamespace(user="user", guild=types.SimpleNamespace(name="guild"),
+                                        channel=types.SimpleNamespace(name="channel"),
+                                        response=Responder(), followup=Responder())
+    await matcher.MatchDynamicButton(3).callback(interaction)
+    assert interaction.followup.content == "Timed out"
+
+
+@pytest.mark.asyncio
+async def test_run_hourly_tasks_concurrently(monkeypatch):
+    """Validate scheduled channel tasks run alongside each other under the cap, and failures are isolated"""
+    now = datetime.now()
+    tomorrow = now + timedelta(days=1)
+    for channel_id in range(1, 9):
+        state.State.set_channel_match_task(channel_id, 3, now.weekday(), now.hour)
+    for channel_id in range(9, 12):
+        state.State.set_channel_match_task(channel_id, 3, tomorrow.weekday(), tomorrow.hour)
+
+    running = []
+    most_running = 0
+    (matched, reminded) = ([], [])
+
+    async def track(done: list, channel: Channel):
+        nonlocal most_running
+        running.append(channel.id)
+        most_running = max(most_running, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(channel.id)
+        if channel.id == 2:
+            raise server_error()
+        done.append(channel.id)
+
+    async def fake_match(channel: Channel, min: int):
+        await track(matched, channel)
+
+    async def fake_reminder(channel: Channel):
+        await track(reminded, channel)
+
+    monkeypatch.setattr(matcher, "match_groups_in_channel", fake_match)
+    monkeypatch.setattr(matcher, "send_reminder", fake_reminder)
+
+    # Archiving failing doesn't stop the tasks, and only happens once they're done
+    archived_after = []
+
+    def fail_archive():
+        archived_after.extend(matched + reminded)
+        raise OSError("Disk full")
+    monkeypatch.setattr(state.State, "archive_history", fail_archive)
+
+    # Channel 8 can't be found
+    bot = types.SimpleNamespace(get_channel=lambda id: Channel(id, []) if id != 8 else None)
+    cog = matcher.MatcherCog(bot, task_concurrency=3)
+    await cog.run_hourly_tasks()
+
+    assert sorted(matched) == [1, 3, 4, 5, 6, 7]
+    assert sorted(reminded) == [9, 10, 11]
+    assert most_running == 3
+    assert sorted(archived_after) == [1, 3, 4, 5, 6, 7, 9, 10, 11]
+
+
+@pytest.mark.asyncio
+async def test_join_role():
+    """Validate everyone with a role who can see the channel joins in one write, if the user is a matcher"""
+    class Response():
+        async def send_message(self, content: str, **kwargs):
+            self.content = content
+
+    visible = {1, 2, 3, 5}
+    role = types.SimpleNamespace(mention="<@&9>", members=[
+        types.SimpleNamespace(id=id, bot=(id == 5)) for id in range(1, 6)])
+    channel = types.SimpleNamespace(
+        id=10, mention="<#10>",
+        permissions_for=lambda m: types.SimpleNamespace(view_channel=m.id in visible))
+    interaction = types.SimpleNamespace(user=types.SimpleNamespace(id=100), channel=channel, response=Response())
+    cog = matcher.MatcherCog(None)
+
+    await cog._set_role_active(interaction, role, True)
+    assert state.State.get_active_users_in_channel(10) == set()
+
+    state.State.set_user_scope(100, state.AuthScope.MATCHER)
+    await cog._set_role_active(interaction, role, True)
+    assert state.State.get_active_users_in_channel(10) == {"1", "2", "3"}
+
+    await cog._set_role_active(interaction, role, False)
+    assert state.State.get_active_users_in_channel(10) == set()
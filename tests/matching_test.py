@@ -8,6 +8,7 @@ import matchy.matching as matching
 import matchy.state as state
 import copy
 import itertools
+from collections.abc import Callable
 from datetime import datetime, timedelta
 
 
@@ -65,6 +66,23 @@ class Member():
         return self._id
 
 
+def make_members_with_history(rand: random.Random, num_members: int, days: int = 0, num_groups: int = 1,
+                              num_roles: int = 7, roles_per_member: int = 3,
+                              grouping: Callable[[list[Member]], list[list[Member]]] | None = None) -> list[Member]:
+    """
+    Make members with random roles, and log them into shuffled groups once a day for the last few days
+    The groups are split evenly between num_groups, unless a grouping function is given to make them
+    The members are left in the order of the latest groups
+    """
+    members = [Member(i, [Role(r) for r in rand.sample(range(1, num_roles + 1), roles_per_member)])
+               for i in range(num_members)]
+    for day in range(days, 0, -1):
+        rand.shuffle(members)
+        groups = grouping(members) if grouping else [members[i::num_groups] for i in range(num_groups)]
+        state.State.log_groups(groups, datetime.now() - timedelta(days=day))
+    return members
+
+
 def members_to_groups_validate(matchees: list[Member], per_group: int):
     """Inner function to validate the main output of the groups function"""
     groups = matching.members_to_groups(matchees, per_group)
@@ -395,6 +413,286 @@ def test_stess_random_groups(per_group, num_members, num_history):
             groups, datetime.now() - timedelta(days=num_history-i))
 
 
+@pytest.mark.parametrize("per_group, num_members, num_history", (
+    (per_group, num_members, num_history)
+    for per_group in range(2, 5)
+    for num_members in range(8, 32, 5)
+    for num_history in (3, 7)))
+def test_bisect_history_finds_matching_cutoff(monkeypatch, per_group, num_members, num_history):
+    """Validate binary searching the history cutoff gives groups that match at a cutoff no older than the walk's"""
+    # Pairs would otherwise be matched optimally, without searching the history at all
+    monkeypatch.setattr(matching, "_PAIRS_MAX_MATCHEES", 0)
+    rand = random.Random(per_group*3 + num_members*5 + num_history*7)
+
+    possible_members = [Member(i) for i in range(num_members*2)]
+    for member in possible_members:
+        member.roles = [Role(i) for i in rand.sample(range(1, 8), 3)]
+
+    for i in range(num_history+1):
+        rand.shuffle(possible_members)
+        members = possible_members[:num_members]
+
+        penalties = matching._PenaltyMatrix(members)
+        cutoffs = penalties.history.timestamps() + [state.datetime_to_epoch(datetime.now())]
+        matches = [matching._match_at_cutoff(penalties, cutoff, per_group) for cutoff in cutoffs]
+        first = next(c for (c, (matched, _)) in enumerate(matches) if matched)
+
+        def ids(groups: list[list[int]]) -> list[list[int]]:
+            return [[members[i].id for i in g] for g in groups]
+
+        linear = matching.members_to_groups(members, per_group, allow_fallback=True)
+        bisected = matching.members_to_groups(members, per_group, allow_fallback=True, bisect_history=True)
+        assert [[m.id for m in g] for g in linear] == ids(matches[first][1])
+        assert [[m.id for m in g] for g in bisected] in [ids(groups) for (matched, groups) in matches[first:]
+                                                         if matched]
+
+        state.State.log_groups(linear, datetime.now() - timedelta(days=num_history-i))
+
+
+def test_history_cutoff_not_monotone(monkeypatch):
+    """Validate channel matches use the oldest cutoff that matches, even when a newer one doesn't"""
+    monkeypatch.setattr(matching, "_LOCAL_SEARCH_ITERATIONS", 0)
+    rand = random.Random(5498)
+    per_group = rand.choice([3, 4, 5])
+    num_members = rand.randint(per_group*2, 22)
+    possible_members = [Member(i, [Role(r) for r in rand.sample(range(1, 8), 3)])
+                        for i in range(num_members + rand.randint(0, 8))]
+    weeks = rand.randint(1, 4)
+    for days in range(weeks, 0, -1):
+        rand.shuffle(possible_members)
+        groups = matching.members_to_groups(possible_members[:num_members], per_group, allow_fallback=True)
+        state.State.log_groups(groups, datetime.now() - timedelta(days=days))
+    rand.shuffle(possible_members)
+    members = possible_members[:num_members]
+
+    # The second cutoff fails to match while the first does, so binary searching skips past the first
+    penalties = matching._PenaltyMatrix(members)
+    cutoffs = penalties.history.timestamps() + [state.datetime_to_epoch(datetime.now())]
+    matches = [matching._match_at_cutoff(penalties, cutoff, per_group) for cutoff in cutoffs]
+    assert [matched for (matched, _) in matches] == [True, False, True, True, True]
+
+    groups = matching.snapshot_to_groups((members, penalties), per_group)
+    assert [[m.id for m in g] for g in groups] == [[members[i].id for i in g] for g in matches[0][1]]
+    bisected = matching.members_to_groups(members, per_group, allow_fallback=True, bisect_history=True,
+                                          penalties=penalties)
+    assert [[m.id for m in g] for g in bisected] == [[members[i].id for i in g] for g in matches[2][1]]
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_parallel_matches_serial(seed):
+    """Validate trying rotations across processes finds the same groups as trying them in turn"""
+    rand = random.Random(seed)
+
+    # Give members lots of overlapping roles so many rotations fail, and some never match
+    possible_members = [Member(i, [Role(r) for r in rand.sample(range(1, 21), rand.randint(8, 18))])
+                        for i in range(60)]
+
+    for i in range(3):
+        rand.shuffle(possible_members)
+        members = possible_members[:40]
+
+        (serial_stats, parallel_stats) = (matching.MatchStats(), matching.MatchStats())
+        serial = matching.members_to_groups(members, 3, allow_fallback=True, bisect_history=True,
+                                            stats=serial_stats)
+        parallel = matching.members_to_groups(members, 3, allow_fallback=True, bisect_history=True,
+                                              stats=parallel_stats, processes=2)
+        assert [[m.id for m in g] for g in serial] == [[m.id for m in g] for g in parallel]
+        assert serial_stats.attempts == parallel_stats.attempts
+        assert serial_stats.scores == parallel_stats.scores
+
+        state.State.log_groups(serial, datetime.now() - timedelta(days=3-i))
+
+
+def test_snapshot_to_groups():
+    """Validate matching from a snapshot gives the same groups without reading the state"""
+    members = make_members_with_history(random.Random(7), 30, 1, 8)
+
+    class Channel():
+        def __init__(self, id: int, members: list[Member]):
+            self.id = id
+            self.members = members
+    channel = Channel(1, members)
+
+    for member in members[:24]:
+        state.State.set_user_active_in_channel(member.id, channel.id)
+
+    expected = matching.active_members_to_groups(channel, 3)
+    snapshot = matching.snapshot_active_members(channel)
+    assert snapshot[0] == members[:24]
+
+    # Clear the state out from under the snapshot
+    state.State = state._State(state._EMPTY_DICT)
+    groups = matching.snapshot_to_groups(snapshot, 3)
+    assert [[m.id for m in g] for g in groups] == [[m.id for m in g] for g in expected]
+
+
+def test_penalty_matrix_matches_reference_score():
+    """Validate the penalty matrix scores matchees the same as the reference scoring function"""
+    rand = random.Random(42)
+    # Log some history with a mix of timestamps
+    members = make_members_with_history(rand, 24, 6, 8)
+
+    penalties = matching._PenaltyMatrix(members)
+    cutoff = datetime.now() - timedelta(days=3, hours=12)
+    prior_matches = penalties.prior_matches(state.datetime_to_epoch(cutoff))
+
+    for i, member in enumerate(members):
+        reference_prior = [id for id, ts in state.State.get_user_matches(member.id).items()
+                           if ts >= state.datetime_to_epoch(cutoff)]
+        for per_group in range(2, 5):
+            group = matching._Group(penalties.roles)
+            for j in rand.sample([j for j in range(len(members)) if j != i], rand.randint(0, 5)):
+                group.append(j)
+            expected = matching.get_member_group_eligibility_score(
+                member, [members[j] for j in group.members], reference_prior, per_group)
+            assert penalties.score(i, group, prior_matches[i], per_group) == expected
+
+
+@pytest.mark.parametrize("per_group", [1, 3, 4])
+def test_attempt_create_groups_batch_scoring(per_group):
+    """Validate scoring against every group at once picks the same groups as scoring them one by one"""
+    rand = random.Random(per_group)
+    members = make_members_with_history(rand, 30, 4, 10, num_roles=6)
+
+    penalties = matching._PenaltyMatrix(members)
+    for cutoff in penalties.history.timestamps():
+        prior_matches = penalties.prior_matches(cutoff)
+        order = list(range(len(members)))
+        rand.shuffle(order)
+
+        # Place each matchee in the first of the lowest scoring groups
+        groups = [matching._Group(penalties.roles) for _ in range(max(len(order)//per_group, 1))]
+        for i in reversed(order):
+            scores = [penalties.score(i, g, prior_matches[i], per_group) for g in groups]
+            if min(scores) > matching._ScoreFactors.UPPER_THRESHOLD:
+                groups = None
+                break
+            groups[scores.index(min(scores))].append(i)
+        expected = [g.members for g in groups] if groups else None
+
+        assert matching._attempt_create_groups(penalties, order, prior_matches, per_group) == expected
+
+
+def test_history_index():
+    """Validate the history index agrees with the state it was built from"""
+    members = make_members_with_history(random.Random(7), 20, 5, 5, roles_per_member=0)
+
+    # Only index a subset of the members
+    members = members[:12]
+    history = matching._HistoryIndex(members)
+
+    expected = [state.datetime_to_epoch(ts) for ts in state.State.get_history_timestamps(members)]
+    assert history.timestamps() == expected
+
+    cutoff = expected[len(expected)//2]
+    for i, member in enumerate(members):
+        partners = set(members[j].id for j in history.partners_since(i, cutoff))
+        assert partners == set(id for id, ts in state.State.get_user_matches(member.id).items()
+                               if ts >= cutoff and id in [m.id for m in members])
+
+
+@pytest.mark.parametrize("per_group, num_members", [
+    (2, 13), (3, 20), (4, 31), (5, 12),
+])
+def test_local_search_improves_groups(per_group, num_members):
+    """Validate local search keeps the same matchees in valid groups without raising the score"""
+    members = make_members_with_history(random.Random(per_group*3 + num_members*5), num_members, 4, num_roles=5,
+                                        grouping=lambda members: matching.members_to_groups(members, per_group))
+
+    penalties = matching._PenaltyMatrix(members)
+    prior_matches = penalties.prior_matches(penalties.history.timestamps()[0])
+    groups = [list(range(len(members)))[i::num_members//per_group]
+              for i in range(num_members//per_group)]
+
+    def total(groups):
+        score = 0
+        for members in groups:
+            group = matching._Group(penalties.roles)
+            for i in members:
+                group.append(i)
+            assert penalties.group_score(group, prior_matches, per_group) == sum(
+                penalties.score(i, group_without(group, i), prior_matches[i], per_group)
+                for i in members)
+            score += penalties.group_score(group, prior_matches, per_group)
+        return score
+
+    def group_without(group, i):
+        without = matching._Group(penalties.roles)
+        for j in group.members:
+            if j != i:
+                without.append(j)
+        return without
+
+    (improved, before, after) = matching._improve_groups(
+        penalties, groups, prior_matches, per_group, 500)
+
+    assert before == total(groups)
+    assert after == total(improved)
+    assert after <= before
+    assert sorted(i for g in improved for i in g) == list(range(num_members))
+    for group in improved:
+        assert per_group <= len(group) < per_group*2
+
+
+def test_members_to_groups_timeout():
+    """Validate running out of time still gives back usable groups and reports it"""
+    members = [Member(i, [Role(1), Role(2), Role(3)]) for i in range(30)]
+    state.State.log_groups([members], datetime.now() - timedelta(days=1))
+
+    # An impossible history with no time at all to match in
+    stats = matching.MatchStats()
+    groups = matching.members_to_groups(members, 3, timeout=0, stats=stats)
+    assert stats.timed_out
+    assert stats.fell_back
+    assert sorted(m.id for g in groups for m in g) == [m.id for m in members]
+    assert all(len(g) >= 3 for g in groups)
+
+    # And plenty of time
+    stats = matching.MatchStats()
+    groups = matching.members_to_groups(members, 3, allow_fallback=True, timeout=60, stats=stats)
+    assert not stats.timed_out
+    assert stats.attempts > 0
+
+
+def all_pairings(items):
+    """Yield every way of splitting the items into pairs"""
+    if not items:
+        yield []
+        return
+    for k in range(1, len(items)):
+        rest = items[1:k] + items[k+1:]
+        for pairing in all_pairings(rest):
+            yield [[items[0], items[k]]] + pairing
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_pairs_is_optimal(seed):
+    """Validate the pairing engine finds the cheapest possible pairs"""
+    members = make_members_with_history(random.Random(seed), 8, 3, 4, num_roles=5, roles_per_member=2)
+
+    penalties = matching._PenaltyMatrix(members)
+    recency = {ts: rank for (rank, ts) in enumerate(penalties.history.timestamps(), 1)}
+
+    def cost(pairs):
+        total = 0
+        for (i, j) in pairs:
+            total += (penalties.roles[i] & penalties.roles[j]).bit_count() * matching._ScoreFactors.REPEAT_ROLE
+            met = dict(zip(penalties.history.partners[i], penalties.history.times[i]))
+            if j in met:
+                total += recency[met[j]] * matching._ScoreFactors.REPEAT_MATCH
+        return total
+
+    pairs = matching._match_pairs(penalties)
+    assert sorted(i for p in pairs for i in p) == list(range(8))
+    assert cost(pairs) == min(cost(p) for p in all_pairings(list(range(8))))
+
+
+def test_match_pairs_odd():
+    """Validate an odd matchee out gets folded into a trio"""
+    groups = matching.members_to_groups([Member(i) for i in range(7)], 2)
+    assert sorted(len(g) for g in groups) == [2, 2, 3]
+
+
 def test_auth_scopes():
 
     id = "1"
@@ -0,0 +1,187 @@
+"""
+    Test functions for the sqlite_state module
+"""
+import os
+import random
+import sqlite3
+import tempfile
+import pytest
+from datetime import datetime, timedelta
+import matchy.matching as matching
+import matchy.sqlite_state as sqlite_state
+import matchy.state as state
+from tests.matching_test import Member
+
+
+def check_same(json_st: state._State, sqlite_st: sqlite_state._SqliteState, users: range, channels: range):
+    """Check both backends give the same answer to every query"""
+    members = [Member(id) for id in users]
+    assert sqlite_st.get_history_timestamps(members) == json_st.get_history_timestamps(members)
+    assert sqlite_st.get_history_timestamps(members[::2]) == json_st.get_history_timestamps(members[::2])
+    for id in users:
+        assert sqlite_st.get_user_matches(id) == dict(json_st.get_user_matches(id))
+        assert sorted(sqlite_st.get_user_match_history(id)) == sorted(json_st.get_user_match_history(id))
+        since = sorted(json_st.get_user_matches(id).values() or [0])[-1]
+        assert sorted(sqlite_st.get_user_partners_since(id, since)) == sorted(
+            json_st.get_user_partners_since(id, since))
+        for other in users:
+            assert sqlite_st.get_pair_matched(id, other) == json_st.get_pair_matched(id, other)
+        assert sqlite_st.get_user_has_scope(id, state.AuthScope.MATCHER) == json_st.get_user_has_scope(
+            id, state.AuthScope.MATCHER)
+        for channel in channels:
+            assert sqlite_st.get_user_active_in_channel(id, channel) == bool(
+                json_st.get_user_active_in_channel(id, channel))
+            assert sqlite_st.get_user_paused_in_channel(id, channel) == json_st.get_user_paused_in_channel(id, channel)
+    for channel in channels:
+        assert sqlite_st.get_active_users_in_channel(channel) == json_st.get_active_users_in_channel(channel)
+        assert sqlite_st.get_paused_users_in_channel(channel) == json_st.get_paused_users_in_channel(channel)
+        assert list(sqlite_st.get_channel_match_tasks(channel)) == list(json_st.get_channel_match_tasks(channel))
+    for day in range(7):
+        time = datetime(2024, 1, 1, 9) + timedelta(days=day)
+        # Tasks across channels come in no particular order
+        assert sorted(sqlite_st.get_active_match_tasks(time)) == sorted(json_st.get_active_match_tasks(time))
+
+
+def random_writes(rand: random.Random, sts: list, users: range, channels: range, count: int):
+    """Make the same random writes to each state"""
+    now = datetime.now()
+    for i in range(count):
+        (user, channel) = (rand.choice(users), rand.choice(channels))
+        action = rand.random()
+        for st in sts:
+            if action < 0.25:
+                members = [Member(id) for id in random.Random(i).sample(users, 6)]
+                st.log_groups([members[:3], members[3:]], now - timedelta(days=count - i))
+            elif action < 0.45:
+                st.set_user_active_in_channel(user, channel, bool(i % 3))
+            elif action < 0.6:
+                st.set_user_paused_in_channel(user, channel, now + timedelta(days=i % 5 - 2))
+            elif action < 0.7:
+                st.reactivate_users(channel)
+            elif action < 0.8:
+                st.set_user_scope(user, state.AuthScope.MATCHER, bool(i % 2))
+            elif action < 0.95:
+                st.set_channel_match_task(channel, i % 4 + 2, i % 7, 9)
+            else:
+                st.remove_channel_match_tasks(channel)
+
+
+def test_matches_json_state():
+    """Test the same writes to both backends give the same answers to every query"""
+    (users, channels) = (range(1, 13), range(100, 104))
+    json_st = state._State(state._EMPTY_DICT)
+    sqlite_st = sqlite_state._SqliteState()
+    random_writes(random.Random(5), [json_st, sqlite_st], users, channels, 300)
+    check_same(json_st, sqlite_st, users, channels)
+
+
+def test_import_from_json():
+    """Test a new database imports everything from the JSON state, only the once"""
+    (users, channels) = (range(1, 13), range(100, 104))
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'state.json')
+        db_path = os.path.join(tmp, 'state.db')
+        json_st = state.load_from_file(json_path)
+        random_writes(random.Random(8), [json_st], users, channels, 200)
+
+        sqlite_st = sqlite_state.load_from_db(db_path, import_from=json_path)
+        check_same(json_st, sqlite_st, users, channels)
+
+        # The JSON state has been left alone
+        assert state.load_from_file(json_path)._dict == json_st._dict
+        assert os.path.isfile(json_path)
+
+        sqlite_st.set_user_scope(1, state.AuthScope.MATCHER, False)
+        sqlite_st.close()
+        sqlite_st = sqlite_state.load_from_db(db_path, import_from=json_path)
+        assert not sqlite_st.get_user_has_scope(1, state.AuthScope.MATCHER)
+        sqlite_st.close()
+
+
+def test_transaction():
+    """Test a transaction commits any number of writes at once, or rolls all of them back"""
+    st = sqlite_state._SqliteState()
+    with st.transaction():
+        st.set_users_active_in_channel([1, 2, 3], 4)
+        st.set_channel_match_task(4, 3, 0, 9)
+
+    with pytest.raises(sqlite3.IntegrityError):
+        with st.transaction():
+            st.set_users_active_in_channel([1, 2, 3], 4, False)
+            st.set_channel_match_task(4, "lots", 0, 9)
+
+    assert st.get_active_users_in_channel(4) == {"1", "2", "3"}
+    assert list(st.get_channel_match_tasks(4)) == [(0, 9, 3)]
+
+    # Values are converted where they can be, the same as the JSON schema
+    st.set_channel_match_task(4, "5", 0, 9)
+    assert list(st.get_channel_match_tasks(4)) == [(0, 9, 5)]
+
+
+def test_history_timestamps_is_indexed():
+    """Test looking up history timestamps uses the table's key, rather than scanning every match"""
+    st = sqlite_state._SqliteState()
+    plan = " ".join(row[-1] for row in st._db.execute(
+        "EXPLAIN QUERY PLAN SELECT high FROM pairs WHERE low = ?", (1,)))
+    assert "USING PRIMARY KEY" in plan
+
+    plan = " ".join(row[-1] for row in st._db.execute(
+        "EXPLAIN QUERY PLAN SELECT user FROM channels WHERE channel = ? AND active", (1,)))
+    assert "channels_active" in plan
+
+
+def test_members_to_groups(monkeypatch):
+    """Test matching works on top of the database"""
+    st = sqlite_state._SqliteState()
+    monkeypatch.setattr(state, "State", st)
+    members = [Member(id) for id in range(1, 13)]
+    for week in range(3):
+        groups = matching.members_to_groups(members, 3)
+        st.log_groups(groups, datetime.now() - timedelta(weeks=3 - week))
+    assert len(st.get_history_timestamps(members)) == 3
+
+
+def test_migrate_to_v2():
+    """Test a v1 database has its matches moved into one record per pair, with epoch times"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'state.db')
+        db = sqlite3.connect(path)
+        db.executescript(sqlite_state._CREATE_TABLES)
+        db.executemany("INSERT INTO matches (user, other, ts) VALUES (?, ?, ?)", [
+            (1, 2, "2024-01-01 09:00:00.000001"), (2, 1, "2024-01-01 09:00:00.000001"),
+            (1, 3, "2024-01-08 09:00:00.000000"), (3, 1, "2024-01-08 09:00:00.000000")])
+        db.execute("INSERT INTO channels (user, channel, active, reactivate) VALUES (1, 10, 0, ?)",
+                   ("2024-02-01 09:00:00.500000",))
+        db.execute("INSERT INTO channels (user, channel, active) VALUES (2, 10, 1)")
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+        db.close()
+
+        st = sqlite_state.load_from_db(path)
+        assert st.get_user_matches(1) == {2: state.ts_to_epoch("2024-01-01 09:00:00.000001"),
+                                          3: state.ts_to_epoch("2024-01-08 09:00:00.000000")}
+        assert st.get_user_matches(3) == {1: state.ts_to_epoch("2024-01-08 09:00:00.000000")}
+        assert st.get_paused_users_in_channel(10) == {"1": state.ts_to_epoch("2024-02-01 09:00:00.500000")}
+        assert st.get_active_users_in_channel(10) == {"2"}
+        assert st._db.execute("SELECT count(*) FROM pairs").fetchone() == (2,)
+        st.close()
+
+
+def test_history_retention():
+    """Test the database archives the same history as the JSON state"""
+    (users, channels) = (range(1, 13), range(100, 104))
+    json_st = state._State(state._EMPTY_DICT)
+    sqlite_st = sqlite_state._SqliteState()
+    random_writes(random.Random(9), [json_st, sqlite_st], users, channels, 300)
+    full = {id: json_st.get_user_matches(id) for id in users}
+
+    for st in (json_st, sqlite_st):
+        st.set_retention(max_age=timedelta(days=150))
+    assert sqlite_st.archive_history() == 0
+    check_same(json_st, sqlite_st, users, channels)
+
+    # Groups share times, so which of the partners tied for the oldest are archived can differ
+    sqlite_st.set_retention(max_partners=4)
+    for id in users:
+        assert len(sqlite_st.get_user_matches(id)) <= 4
+        assert sqlite_st.get_user_full_matches(id) == full[id]
@@ -2,8 +2,16 @@
     Test functions for the state module
 """
 import matchy.state as state
+import copy
+import itertools
+import json
+import pytest
+import random
 import tempfile
+import time
 import os
+from datetime import datetime, timedelta
+from schema import SchemaError
 
 
 def test_basic_state():
@@ -64,3 +72,501 @@ def test_channeljoin():
 
         st.set_user_active_in_channel(1, "2", False)
         assert not st.get_user_active_in_channel(1, "2")
+
+
+def test_journal_replay():
+    """Test writes are journalled rather than saved, and replayed on load"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        snapshot = state._load(path)
+
+        st.set_user_scope(1, state.AuthScope.MATCHER)
+        st.set_user_active_in_channel(1, "2", True)
+        st.set_user_active_in_channel(3, "2", True)
+        st.set_user_active_in_channel(3, "2", False)
+        st.set_user_scope(1, state.AuthScope.MATCHER, False)
+
+        # Only the journal has been written to
+        assert state._load(path) == snapshot
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 5
+
+        st = state.load_from_file(path)
+        assert not st.get_user_has_scope(1, state.AuthScope.MATCHER)
+        assert st.get_user_active_in_channel(1, "2")
+        assert not st.get_user_active_in_channel(3, "2")
+
+        # Loading saves a fresh snapshot and drops the journal
+        assert state._load(path) == st.dump()
+        assert not os.path.isfile(path + ".journal")
+
+
+def test_journal_torn_entry():
+    """Test an incomplete final journal entry is skipped"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.set_user_active_in_channel(1, "2", True)
+        with open(path + ".journal", "a") as f:
+            f.write('[["set", ["users", "3"')
+
+        st = state.load_from_file(path)
+        assert st.get_user_active_in_channel(1, "2")
+        assert "3" not in st._users
+
+
+def test_journal_compaction(monkeypatch):
+    """Test the journal is compacted into the snapshot once it's grown too large"""
+    monkeypatch.setattr(state, "_JOURNAL_MAX_ENTRIES", 3)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+
+        for user in range(1, 6):
+            st.set_user_active_in_channel(user, "2", True)
+        st._journal.wait()
+
+        # The first three writes were compacted, and the rest are left in the journal
+        snapshot = state._load(path)
+        assert sorted(snapshot[state._Key.USERS]) == ["1", "2", "3"]
+        assert not os.path.isfile(path + ".journal.old")
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 2
+
+        st = state.load_from_file(path)
+        assert all(st.get_user_active_in_channel(user, "2") for user in range(1, 6))
+
+
+def test_dump_is_a_copy():
+    """Test a dump isn't changed by later writes, so it can be serialised on another thread"""
+    class Member():
+        def __init__(self, id: int):
+            self.id = id
+
+    st = state._State(state._EMPTY_DICT)
+    st.set_user_active_in_channel(1, "2", True)
+    st.log_groups([[Member(1), Member(2)]])
+    dump = st.dump()
+    before = copy.deepcopy(dump)
+
+    st.set_user_active_in_channel(1, "2", False)
+    st.set_user_active_in_channel(3, "2", True)
+    st.set_user_scope(1, state.AuthScope.MATCHER)
+    st.log_groups([[Member(1), Member(3)]])
+    assert dump == before
+
+
+def test_failed_compaction_keeps_write(monkeypatch):
+    """Test a write that's been journalled isn't failed by compacting the journal afterwards"""
+    monkeypatch.setattr(state, "_JOURNAL_MAX_ENTRIES", 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.set_user_active_in_channel(1, "9", True)
+
+        def fail(src, dst):
+            raise OSError("Disk full")
+        monkeypatch.setattr(os, "replace", fail)
+        st.set_user_active_in_channel(2, "9", True)
+        assert st.get_user_active_in_channel(2, "9")
+        monkeypatch.undo()
+
+        st = state.load_from_file(path)
+        assert st.get_user_active_in_channel(1, "9")
+        assert st.get_user_active_in_channel(2, "9")
+
+
+def test_failed_write_rolls_back():
+    """Test a write that fails validation leaves the state and journal untouched"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.set_channel_match_task("1", 3, 0, 9)
+        st.set_user_active_in_channel(1, "1", True)
+        before = copy.deepcopy(st._dict)
+
+        with pytest.raises(SchemaError):
+            st.set_channel_match_task("1", "lots", 0, 9)
+        with pytest.raises(SchemaError):
+            st.set_channel_match_task("2", "lots", 1, 10)
+
+        assert st._dict == before
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 2
+
+        # Later writes carry on as normal
+        st.set_channel_match_task("1", 4, 0, 9)
+        assert list(st.get_channel_match_tasks("1")) == [(0, 9, 4)]
+        assert state.load_from_file(path)._dict == st._dict
+
+
+def test_write_only_touches_changed_paths():
+    """Test writes change the state in place, and only journal the paths they touched"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.set_user_active_in_channel(1, "1", True)
+        user = st._users["1"]
+
+        st.set_user_active_in_channel(2, "1", True)
+        st.set_user_scope(1, state.AuthScope.MATCHER)
+        assert st._users["1"] is user
+
+        with open(path + ".journal") as f:
+            assert [json.loads(line) for line in f] == [
+                [["set", ["users", "1"], {"channels": {"1": {"active": True}}}]],
+                [["set", ["users", "2"], {"channels": {"1": {"active": True}}}]],
+                [["set", ["users", "1", "scopes"], ["matcher"]]],
+            ]
+
+
+def test_channel_index():
+    """Test the channel index always agrees with the user entries, through writes, failures and reloads"""
+    def check(st: state._State):
+        for channel in ("1", "2", "3"):
+            assert st.get_active_users_in_channel(channel) == set(
+                id for id in st._users if st.get_user_active_in_channel(id, channel))
+            assert st.get_paused_users_in_channel(channel) == {
+                id: st.get_user_paused_in_channel(id, channel)
+                for id in st._users if st.get_user_paused_in_channel(id, channel)}
+
+    rand = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        for _ in range(200):
+            (user, channel) = (rand.randint(1, 8), str(rand.randint(1, 3)))
+            action = rand.random()
+            if action < 0.4:
+                st.set_user_active_in_channel(user, channel, rand.random() < 0.7)
+            elif action < 0.7:
+                st.set_user_paused_in_channel(user, channel, datetime.now() + timedelta(days=rand.randint(-2, 2)))
+            elif action < 0.8:
+                st.reactivate_users(channel)
+            else:
+                # Fails validation part way through, after the user's been changed
+                with pytest.raises(SchemaError):
+                    with st.transaction():
+                        st.set_user_active_in_channel(user, channel, True)
+                        st._users[str(user)][state._Key.CHANNELS][channel]["bad"] = True
+            check(st)
+
+        check(state.load_from_file(path))
+
+
+def test_reactivate_users():
+    """Test only users who are due are reactivated, in a single write"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        past = datetime.now() - timedelta(days=1)
+        future = datetime.now() + timedelta(days=1)
+
+        for user in range(1, 5):
+            st.set_user_paused_in_channel(user, "1", past)
+        st.set_user_paused_in_channel(5, "1", future)
+        st.set_user_paused_in_channel(6, "2", past)
+        # Paused again for longer, and unpaused, after the first pause
+        st.set_user_paused_in_channel(3, "1", future)
+        st.set_user_active_in_channel(4, "1", False)
+
+        # Reloading rebuilds the heap from the state
+        st = state.load_from_file(path)
+        st.reactivate_users("1")
+        assert [bool(st.get_user_active_in_channel(user, "1")) for user in range(1, 6)] == [
+            True, True, False, False, False]
+        assert not st.get_user_active_in_channel(6, "2")
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 1
+
+        # Nothing left that's due, so nothing's written
+        st.reactivate_users("1")
+        assert not os.path.isfile(path + ".journal.old")
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 1
+        assert sorted(st._reactivations["1"]) == [(state.datetime_to_epoch(future), "3"),
+                                                  (state.datetime_to_epoch(future), "5")]
+
+
+def test_transaction():
+    """Test a transaction journals any number of writes once, or rolls all of them back"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+
+        with st.transaction():
+            st.set_user_scope(1, state.AuthScope.MATCHER)
+            st.set_users_active_in_channel([1, 2, 3], "4")
+            st.set_channel_match_task("4", 3, 0, 9)
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 1
+
+        before = copy.deepcopy(st._dict)
+        with pytest.raises(SchemaError):
+            with st.transaction():
+                st.set_users_active_in_channel([1, 2, 3], "4", False)
+                st.set_channel_match_task("4", "lots", 0, 9)
+        assert st._dict == before
+        assert st.get_active_users_in_channel("4") == {"1", "2", "3"}
+
+        st = state.load_from_file(path)
+        assert st._dict == before
+
+
+def test_tracked_dict_operators():
+    """Test in-place merges and popped items are journalled, and rolled back"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.set_user_active_in_channel(1, "2", True)
+
+        users = st._users
+        with st.transaction():
+            users |= {"3": {}, "4": {}}
+            assert users.popitem() == ("4", {})
+        assert list(state.load_from_file(path)._users) == ["1", "3"]
+
+        before = copy.deepcopy(st._dict)
+        with pytest.raises(RuntimeError):
+            with st.transaction():
+                users.popitem()
+                users |= {"5": {}}
+                raise RuntimeError()
+        assert st._dict == before
+        assert list(st._users) == ["1", "3"]
+
+
+def test_debounced_writes():
+    """Test writes in quick succession are journalled together once they settle, and flushed on demand"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.persist_in_background(0.2, 10)
+
+        for user in range(1, 51):
+            st.set_user_active_in_channel(user, "1", True)
+        assert not os.path.isfile(path + ".journal")
+
+        st.flush()
+        assert st._journal.writes == 50
+        assert st._journal.appends == 1
+        assert st._journal.coalesced == 49
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 50
+        assert state.load_from_file(path)._dict == st._dict
+
+
+def test_debounced_writes_max_staleness():
+    """Test buffered writes are journalled by the max staleness, even while more keep coming in"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.persist_in_background(10, 0.1)
+
+        st.set_user_active_in_channel(1, "1", True)
+        for _ in range(100):
+            if os.path.isfile(path + ".journal"):
+                break
+            time.sleep(0.05)
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 1
+        st.flush()
+
+
+def test_debounced_writes_kept_on_failure(monkeypatch):
+    """Test buffered writes that fail to append stay buffered, ahead of newer ones, until they can be"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.persist_in_background(10, 10)
+        st.set_user_active_in_channel(7, "1", True)
+
+        def fail(lines: list[str]):
+            raise OSError("Disk full")
+        monkeypatch.setattr(st._journal, "_append", fail)
+        with pytest.raises(OSError):
+            st.flush()
+        monkeypatch.undo()
+
+        st.set_user_active_in_channel(8, "1", True)
+        st.flush()
+        with open(path + ".journal") as f:
+            assert ['"7"' in line for line in f.readlines()] == [True, False]
+        assert state.load_from_file(path)._dict == st._dict
+
+
+def test_debounced_failed_compaction_keeps_writes(monkeypatch):
+    """Test buffered writes are kept once each when compacting them fails, and the writes themselves succeed"""
+    monkeypatch.setattr(state, "_JOURNAL_MAX_ENTRIES", 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        st.persist_in_background(10, 10)
+
+        def fail(lines: list[str]):
+            raise OSError("Disk full")
+        monkeypatch.setattr(st._journal, "_append", fail)
+        for user in range(1, 4):
+            st.set_user_active_in_channel(user, "9", True)
+        assert all(st.get_user_active_in_channel(user, "9") for user in range(1, 4))
+        monkeypatch.undo()
+
+        st.flush()
+        with open(path + ".journal") as f:
+            assert len(f.readlines()) == 3
+        assert state.load_from_file(path)._dict == st._dict
+
+
+def test_migrate_to_v5():
+    """Test v4 matches are moved into one record per pair, with epoch times"""
+    v4 = {
+        "version": 4,
+        "users": {
+            "1": {"matches": {"2": "2024-01-01 09:00:00.000001", "3": "2024-01-08 09:00:00.000000"},
+                  "channels": {"10": {"active": False, "reactivate": "2024-02-01 09:00:00.000000"}}},
+            "2": {"matches": {"1": "2024-01-01 09:00:00.000001"}},
+            "3": {"matches": {"1": "2024-01-08 09:00:00.000000"}, "scopes": ["matcher"]},
+        },
+        "tasks": {},
+    }
+    st = state._State(v4)
+    assert sorted(st.dump()[state._Key.MATCHES]) == [
+        [1, 2, state.ts_to_epoch("2024-01-01 09:00:00.000001")],
+        [1, 3, state.ts_to_epoch("2024-01-08 09:00:00.000000")],
+    ]
+    assert st.get_user_matches(1) == {2: state.ts_to_epoch("2024-01-01 09:00:00.000001"),
+                                      3: state.ts_to_epoch("2024-01-08 09:00:00.000000")}
+    assert st.get_user_matches(3) == {1: state.ts_to_epoch("2024-01-08 09:00:00.000000")}
+    assert st.get_user_paused_in_channel(1, 10) == state.ts_to_epoch("2024-02-01 09:00:00.000000")
+    assert st.get_user_has_scope(3, state.AuthScope.MATCHER)
+    assert "matches" not in st._users["1"]
+
+
+def test_matches_stored_once():
+    """Test each pair is journalled and saved once, and replayed on load"""
+    class Member():
+        def __init__(self, id: int):
+            self.id = id
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        first = datetime(2024, 1, 1, 9)
+        st.log_groups([[Member(3), Member(1), Member(2)]], first)
+        st.log_groups([[Member(2), Member(1)], [Member(4), Member(5)]], first + timedelta(weeks=1))
+
+        with open(path + ".journal") as f:
+            assert [json.loads(line) for line in f] == [
+                [["set", ["matches", 1, 3], state.datetime_to_epoch(first)],
+                 ["set", ["matches", 2, 3], state.datetime_to_epoch(first)],
+                 ["set", ["matches", 1, 2], state.datetime_to_epoch(first)]],
+                [["set", ["matches", 1, 2], state.datetime_to_epoch(first + timedelta(weeks=1))],
+                 ["set", ["matches", 4, 5], state.datetime_to_epoch(first + timedelta(weeks=1))]],
+            ]
+
+        st = state.load_from_file(path)
+        assert len(st._matches) == 4
+        assert sorted(state._load(path)[state._Key.MATCHES]) == [
+            [1, 2, state.datetime_to_epoch(first + timedelta(weeks=1))],
+            [1, 3, state.datetime_to_epoch(first)],
+            [2, 3, state.datetime_to_epoch(first)],
+            [4, 5, state.datetime_to_epoch(first + timedelta(weeks=1))],
+        ]
+        assert st.get_history_timestamps([Member(1), Member(2), Member(3)]) == [first, first + timedelta(weeks=1)]
+
+        # Matches are rolled back along with everything else
+        with pytest.raises(SchemaError):
+            with st.transaction():
+                st.log_groups([[Member(1), Member(4)], [Member(2), Member(5)]])
+                st.set_channel_match_task("1", "lots", 0, 9)
+        assert len(st._matches) == 4
+        assert st.get_user_matches(4) == {5: state.datetime_to_epoch(first + timedelta(weeks=1))}
+        assert state.load_from_file(path).dump() == st.dump()
+
+
+def test_pair_history_queries():
+    """Test the pair history graph answers the same as searching every match, through writes and rollbacks"""
+    class Member():
+        def __init__(self, id: int):
+            self.id = id
+
+    rand = random.Random(11)
+    st = state._State(state._EMPTY_DICT)
+    # Every pair and when they last matched
+    reference: dict[frozenset, int] = {}
+    start = datetime(2024, 1, 1)
+    for week in range(60):
+        ts = start + timedelta(days=rand.randint(0, 400))
+        ids = rand.sample(range(1, 30), 12)
+        groups = [[Member(id) for id in ids[i:i+3]] for i in range(0, 12, 3)]
+        if rand.random() < 0.2:
+            with pytest.raises(SchemaError):
+                with st.transaction():
+                    st.log_groups(groups, ts)
+                    st.set_channel_match_task("1", "lots", 0, 9)
+            continue
+        st.log_groups(groups, ts)
+        for group in groups:
+            for (a, b) in itertools.combinations(group, 2):
+                reference[frozenset((a.id, b.id))] = state.datetime_to_epoch(ts)
+
+    since = state.datetime_to_epoch(start + timedelta(days=200))
+    subset = set(rand.sample(range(1, 30), 15))
+    assert st.get_history_times(subset) == sorted(set(
+        ts for pair, ts in reference.items() if pair <= subset))
+    for id in range(1, 31):
+        partners = {other: ts for pair, ts in reference.items() if id in pair for other in pair - {id}}
+        assert st.get_user_matches(id) == partners
+        # Oldest first, though partners matched at the same time can come in any order
+        history = st.get_user_match_history(id)
+        assert sorted(history) == sorted((ts, other) for other, ts in partners.items())
+        assert [ts for (ts, _) in history] == sorted(partners.values())
+        assert sorted(st.get_user_partners_since(id, since)) == sorted(
+            other for other, ts in partners.items() if ts >= since)
+        for other in range(1, 31):
+            assert st.get_pair_matched(id, other) == reference.get(frozenset((id, other)))
+    assert len(st._matches) == len(reference)
+
+
+def test_history_retention():
+    """Test history outside the retention policy is archived, and only read back in when the full history's asked for"""
+    class Member():
+        def __init__(self, id: int):
+            self.id = id
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tmp.json')
+        st = state.load_from_file(path)
+        now = datetime.now()
+        for week in range(10):
+            members = [Member(id) for id in random.Random(week).sample(range(1, 21), 20)]
+            st.log_groups([members[i:i+4] for i in range(0, 20, 4)], now - timedelta(weeks=10 - week))
+        full = {id: dict(st.get_user_matches(id)) for id in range(1, 21)}
+
+        # Nothing's archived until there's a policy
+        assert st.archive_history() == 0
+        st.set_retention(max_age=timedelta(weeks=5, days=1))
+        oldest = state.datetime_to_epoch(now - timedelta(weeks=5, days=1))
+        for id in range(1, 21):
+            assert st.get_user_matches(id) == {other: ts for other, ts in full[id].items() if ts >= oldest}
+
+        # Reloading leaves the archive unread until it's needed
+        st = state.load_from_file(path)
+        assert st._archive._pairs is None
+        assert all(ts >= oldest for (_, _, ts) in st._matches)
+        for id in range(1, 21):
+            assert st.get_user_full_matches(id) == full[id]
+
+        st._retention = (None, 5)
+        assert st.archive_history() > 0
+        assert all(len(st.get_user_matches(id)) <= 5 for id in range(1, 21))
+        # The most recent partners are the ones kept
+        for id in range(1, 21):
+            kept = st.get_user_matches(id)
+            assert min(kept.values()) >= sorted(full[id].values())[-5]
+            assert st.get_user_full_matches(id) == full[id]
+
+        st = state.load_from_file(path)
+        assert all(len(st.get_user_matches(id)) <= 5 for id in range(1, 21))
+        assert all(st.get_user_full_matches(id) == full[id] for id in range(1, 21))
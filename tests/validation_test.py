@@ -0,0 +1,123 @@
+"""
+    Test functions for the validation module
+"""
+import copy
+import random
+import pytest
+from schema import SchemaError
+import matchy.state as state
+import matchy.validation as validation
+
+# A state with at least one of every kind of entry
+_FULL_DICT = {
+    "version": 5,
+    "users": {
+        "1": {
+            "scopes": ["matcher"],
+            "channels": {
+                "10": {"active": True},
+                "11": {"active": False, "reactivate": 1706778000000000},
+            },
+        },
+        "2": {},
+    },
+    "matches": [[1, 2, 1704099600000000], [1, 3, 1704704400000000]],
+    "tasks": {
+        "10": {"match_tasks": [{"members_min": 3, "weekdays": 0, "hours": 9}]},
+        "11": {},
+    },
+}
+
+# Values to swap in while fuzzing, covering the conversions the schema allows and doesn't
+_VALUES = [None, True, 0, 3, 2.5, "", "4", "x", [], ["a"], [1], {}, {"a": 1}, {"active": True}, 1j]
+
+
+def accepts(validate, data) -> bool:
+    try:
+        validate(data)
+        return True
+    except SchemaError:
+        return False
+
+
+def paths(data, path=()):
+    """Yield every path within some data, through dicts and lists"""
+    yield path
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from paths(value, path + (key,))
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            yield from paths(value, path + (index,))
+
+
+def mutate(data, rand: random.Random) -> tuple:
+    """Randomly change, add or remove an entry in some data, returning the path of the dict entry changed"""
+    path = rand.choice([p for p in paths(data) if p])
+    parent = data
+    for key in path[:-1]:
+        parent = parent[key]
+    action = rand.random()
+    value = copy.deepcopy(rand.choice(_VALUES))
+    if isinstance(parent, list):
+        parent[path[-1]] = value
+    elif action < 0.3:
+        del parent[path[-1]]
+    elif action < 0.5:
+        path = path[:-1] + (rand.choice(["x", 5, "matches", "active", "12"]),)
+        parent[path[-1]] = value
+    else:
+        parent[path[-1]] = value
+    return path
+
+
+def test_compiled_schema_matches_schema():
+    """Validate the compiled schema accepts and rejects the same data as the schema library"""
+    validator = validation.compile_schema(state._SCHEMA)
+    assert accepts(validator.validate, _FULL_DICT)
+    assert accepts(validator.validate, state._EMPTY_DICT)
+
+    rand = random.Random(42)
+    (accepted, rejected) = (0, 0)
+    for _ in range(1500):
+        data = copy.deepcopy(_FULL_DICT)
+        for _ in range(rand.randint(1, 3)):
+            mutate(data, rand)
+        expected = accepts(state._SCHEMA.validate, data)
+        assert accepts(validator.validate, data) == expected, data
+        accepted += expected
+        rejected += not expected
+
+    # Make sure both sides were covered
+    assert accepted > 100 and rejected > 100
+
+
+def test_validate_path_matches_schema():
+    """Validate checking only a changed path agrees with validating everything"""
+    validator = validation.compile_schema(state._SCHEMA)
+    rand = random.Random(7)
+    for _ in range(1500):
+        data = copy.deepcopy(_FULL_DICT)
+        path = mutate(data, rand)
+
+        # Anything inside a list is validated as the whole list
+        (dict_path, parent) = ((), data)
+        for key in path:
+            if not isinstance(parent, dict):
+                break
+            dict_path += (key,)
+            parent = parent.get(key)
+
+        expected = accepts(state._SCHEMA.validate, data)
+        assert accepts(lambda d: validation.validate_path(validator, d, dict_path), data) == expected, data
+
+
+@pytest.mark.parametrize("schema, error", [
+    ({str: int}, ValueError),
+    ({("a", "b"): int}, TypeError),
+    ({"a": lambda x: x}, TypeError),
+])
+def test_unsupported_schema(schema, error):
+    """Validate parts of the schema library that aren't supported are refused up front"""
+    with pytest.raises(error):
+        validation.compile_schema(schema)